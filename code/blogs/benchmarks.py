@@ -0,0 +1,79 @@
+"""
+benchmarks.py
+
+Times the blog roll heuristics over a corpus of saved pages, and checks
+that the anchor cluster detector finds the same blog rolls as the old,
+quadratic one. The corpus is a directory of pages, one per file, named
+after the host of the blog, e.g. fluokids.blogspot.com.html.
+
+	python benchmarks.py <corpus directory> [rounds]
+"""
+import os
+import sys
+import time
+
+from BeautifulSoup import BeautifulSoup
+
+from zoid.blogs.models import BlogRoll
+
+class SavedPage(object):
+	"""Stands in for a blog, as far as BlogRoll is concerned."""
+	def __init__(self, url, html):
+		self.url = url
+		self.data = BeautifulSoup(html)
+
+def quadratic_anchor_cluster_list(roll, div):
+	"""The anchor cluster detector as it used to be, stringifying the
+	parent of every anchor, and then its children."""
+	visited = set()
+	link_list = []
+	for anchor in div.findAll('a'):
+		if anchor.has_key('href') and anchor.parent.contents and \
+		 str(anchor.parent.contents) not in visited:
+			visited.add(str(anchor.parent.contents))
+			aParent = anchor.parent
+			anchors = aParent.findAll('a', recursive = False)
+			if len(anchors) > 5:
+				blockSize = sum([len(str(a)) for a in aParent.contents])
+				anchorSize = sum([len(str(a)) for a in anchors])
+				if (1.0*anchorSize)/blockSize > 0.9:
+					valid_list = [x['href'] for x in anchors \
+					 if x.has_key('href') and roll.valid_href(x['href'])]
+					if len(valid_list) == len(anchors):
+						link_list.extend(valid_list)
+	return link_list
+
+def load_corpus(path):
+	pages = []
+	for name in sorted(os.listdir(path)):
+		html = open(os.path.join(path, name)).read()
+		pages.append(SavedPage('http://' + name.replace('.html', ''), html))
+	return pages
+
+def timed(func, pages, rounds):
+	start = time.time()
+	for i in range(rounds):
+		results = [func(BlogRoll(page), page.data) for page in pages]
+	return (time.time() - start) / rounds, results
+
+def main(path, rounds=3):
+	pages = load_corpus(path)
+	print "%d pages, %d bytes" % \
+	 (len(pages), sum([len(str(page.data)) for page in pages]))
+	old, expected = timed(quadratic_anchor_cluster_list, pages, rounds)
+	new, found = timed(lambda roll, div: roll.anchor_cluster_list(div), \
+	 pages, rounds)
+	print "quadratic: %.3fs, linear: %.3fs per round" % (old, new)
+	# Parents with the same markup used to count once, but blog rolls
+	# are uniq'ed anyway
+	different = [page.url for page, a, b in zip(pages, expected, found) \
+	 if set(a) != set(b)]
+	for url in different: print "Different blog roll: " + url
+	return not different
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print __doc__
+		sys.exit(2)
+	rounds = len(sys.argv) > 2 and int(sys.argv[2]) or 3
+	sys.exit(not main(sys.argv[1], rounds))
@@ -1,169 +1,414 @@
 import feedparser
 import urllib2
 import re
+import os
 import socket
-import networkx as NX
 
-from numpy import linalg, ones, dot, array, abs, size, sum, allclose
-from scipy import sparse
+from numpy import linalg, ones, dot, array, abs, size, sum, allclose, \
+ zeros, concatenate, int64, float64
 from math import log
 from urlparse import urlparse
-from BeautifulSoup import BeautifulSoup, SoupStrainer
+from BeautifulSoup import BeautifulSoup, SoupStrainer, Tag
 
-from zoid.feeds.models import Feed, IllegalFeedException
+from zoid.feeds.models import Feed, Post, Enclosure, IllegalFeedException, \
+ stale_tracks
 from zoid.music.models import Track
-from zoid.helpers.pagerank import Pagerank
-from zoid.helpers.utils import canonical_url, www_url, uniq, flatten, get_data_from_url, IllegalBlogException
+from zoid.helpers.pagerank_sparse import SparseRank, TOLERANCE, NORM, \
+ MAX_ITERATIONS
+from zoid.helpers.bulk import update_column, insert_rows, delete_rows, chunks
+from zoid.helpers.pool import WorkerPool
+from zoid.helpers.urlclass import UrlClassifier
+from zoid.helpers.utils import canonical_url, canonical_urls, www_url, host_key, uniq, flatten, get_data_from_url, IllegalBlogException, LRUCache, pack_text, unpack_text
 
-from django.db import models, connection
+from django.conf import settings
+from django.db import models, connection, transaction
+from django.utils import simplejson
 
 
 ##############################################################################
 class BlogRank(models.Manager):
 	"""Calculates the page rank for a nest of blogs."""
 	
-	graph = NX.DiGraph()
-	max_id = 0
-	normal_matrix = None
-	invalid = True
-	index_to_id = {}
+	# Number of rows we read from the database cursor at a time
+	FETCH_CHUNK = 10000
 	
-	def rank(self):
+	# The ranks and the link graph of the last run in this process,
+	# and the number of iterations a full recompute needed, for
+	# incremental runs.
+	last_ids = None
+	last_ranks = None
+	last_graph = None
+	full_iterations = None
+	
+	# Results we keep per seed set, and seed sets we keep at most
+	PERSONAL_RESULTS = 50
+	PERSONAL_CACHE_SIZE = 5000
+	# The highest ranked blogs write_similar stores similar blogs for,
+	# the number of them solved together, which is the width of the
+	# dense block iterated, and the number of similar blogs per blog
+	SIMILAR_BLOGS = 1000
+	SIMILAR_BATCH = 8
+	SIMILAR_COUNT = 10
+	
+	# The link graph as loaded by this process, the modification time
+	# of the snapshot it was mapped from, and the results of
+	# personalized ranks, keyed by seed set.
+	graph_cache = None
+	graph_mtime = None
+	personal_cache = LRUCache(PERSONAL_CACHE_SIZE)
+	# Relative change in the rank of a blog after which the statistics
+	# of its tracks are recomputed
+	RANK_CHANGE = 0.01
+	
+	def rank(self, incremental=False, tolerance=TOLERANCE, norm=NORM, \
+	 max_iterations=MAX_ITERATIONS):
 		"""Computes the page rank for a link graph, by first
-		inserting all the blogs and blog relations, and then
-		calculating the graph and returning it."""
-		relations = BlogRelation.objects.all()
-		if len(relations) == 0: return False
-		blogs = Blog.objects.all()
-		# Sets up the rank graph
-		for blog in blogs:
-			self.insert(blog.id)
-		for anchor in relations: 
-			self.link(anchor.source.id,anchor.destination.id)
-		# Calculate the page rank
-		rank_vector = self.get_rank()
+		reading all the blogs and blog relations, and then
+		calculating the rank and writing it back.
+		
+		If incremental is set, the power method starts from the
+		ranks of the last run instead of from scratch, which is
+		what you want after a spider run that only added a few
+		blogs. 
+		
+		The power method stops when the residual in the given norm
+		is below tolerance, or after max_iterations. Returns a dict
+		with the stats of the power method (see power_method), the
+		number of iterations saved compared to the last full run in
+		this process (or, without one, saved_at_most, compared to the
+		worst case of a cold start), the number of new blogs and the
+		links from or to them, and the number of links added and
+		removed since the last run (see previous_graph)."""
+		if BlogRelation.objects.count() == 0: return False
+		if self.snapshot_path(): graph = self.graph()
+		else: graph = self.load_graph()
+		stats = {'blogs': graph.size, 'links': graph.links.nnz}
+		start = None
+		if incremental:
+			start, new = graph.warm_start(*self.previous_rank())
+			stats['new_blogs'] = int(new.sum())
+			stats['links_to_new_blogs'] = graph.links_touching(new)
+		previous = self.previous_graph()
+		if previous is not None:
+			stats['added_links'], stats['removed_links'] = \
+			 graph.link_changes(previous)
+		rank_vector = graph.find_dominant(start, tolerance, norm, max_iterations)
+		stats.update(graph.stats)
+		if incremental and self.full_iterations:
+			stats['saved'] = max(self.full_iterations - graph.iterations, 0)
+		elif incremental:
+			stats['saved_at_most'] = \
+			 max(graph.cold_iterations(tolerance) - graph.iterations, 0)
+		elif graph.stats['converged']:
+			self.full_iterations = graph.iterations
+		if not graph.stats['converged']:
+			print "Page rank did not converge in %d iterations (residual %g)" % \
+			 (graph.iterations, graph.stats['residuals'][-1])
+		self.last_ids, self.last_ranks = graph.ids, rank_vector
+		self.keep_graph(graph)
+		self.invalidate(graph)
+		# The rank vector sums to one, scale it so that an average
+		# blog has rank 1.0 no matter how many blogs we have.
+		rank_vector = rank_vector * len(rank_vector)
 		# And update the database
-		for rank in rank_vector:
-			blog = Blog.objects.filter(id=rank[0])
-			if blog:
-				blog[0].rank = rank[1]
-				blog[0].save()
-
-	def insert(self, id):
-		"""Inserts a URL in to the pagerank graph. Returns the ID
-		of the inserted URL. If the URL is in the graph already,
-		return that ID instead."""
-		self.graph.add_node(id)
-		self.index_to_id[self.max_id] = id
-		self.max_id+=1
-		self.invalidate()
-		return id
-    
-	def invalidate(self):
-		"""Marks the pagerank as invalid for the current setup."""
-		self.invalid = True
-		if self.normal_matrix: self.normal_matrix = None
-    
-    
-	def link(self, from_id, to_id):
-		"""Inserts a link in the graph from from_id to to_id."""
-		self.invalidate()
-		self.graph.add_edge((from_id, to_id))
-    
-	def normalize_graph(self):
-		"""Creates a normalized graph, i.e. makes a new graph for actually
-		calculating the pagrank in, and gives columns equal values,
-		and adds constant noise (the damping factor)"""
-		# 1 - The damping factor of the graph
-		DAMP = 0.85
-		adj = NX.adj_matrix(self.graph)#.transpose()
-		idx_max = len(adj)
-		self.normal_matrix = sparse.lil_matrix(adj)
-		for i in range(0,idx_max):
-			col = self.normal_matrix[i,:].todense()
-			col_nonzero = size(col[col>0])
-			if col_nonzero > 0: col[col>0] = DAMP*1.0/col_nonzero
-			else: col = DAMP*1/len(col)
-			col = col + (1.0-DAMP)/idx_max
-			self.normal_matrix[i,:] = col
-
-		# We want the _transpose_ of the adjacency matrix!
-		self.normal_matrix = self.normal_matrix.transpose()
-    
+		self.write_ranks(graph.ids, rank_vector)
+		return stats
+
+	def write_ranks(self, ids, ranks):
+		"""Writes the ranks back to the blogs, in one transaction. Only
+		the rank column is sent, a chunk of blogs per statement. The
+		tracks of blogs whose rank changed by more than RANK_CHANGE
+		since their tracks were last queued are queued for new
+		statistics, and the rank they're queued with is kept."""
+		changed = self.changed_blogs(ids, ranks)
+		update_column(Blog, 'rank', \
+		 [(int(id), float(rank)) for id, rank in zip(ids, ranks)])
+		update_column(Blog, 'scored_rank', [(int(id), float(rank)) \
+		 for id, rank in zip(ids[changed], ranks[changed])])
+		self.queue_tracks(ids[changed])
+	write_ranks = transaction.commit_on_success(write_ranks)
+
+	def changed_blogs(self, ids, ranks):
+		"""A mask of the blogs whose rank differs noticeably from the
+		rank their tracks were last scored with, so that many small
+		changes add up. ids are sorted, as in SparseRank."""
+		stored_ids, stored = self.stored_rank('scored_rank')
+		old = zeros(len(ids))
+		pos = SparseRank.positions(ids, stored_ids)
+		old[pos[pos >= 0]] = stored[pos >= 0]
+		return abs(ranks - old) > self.RANK_CHANGE * abs(old)
+
+	def queue_tracks(self, blog_ids):
+		"""Queues the tracks posted by blogs for new statistics."""
+		qn = connection.ops.quote_name
+		cursor = connection.cursor()
+		tracks = []
+		for ids in chunks([int(id) for id in blog_ids]):
+			cursor.execute("SELECT DISTINCT e.%s FROM %s e INNER JOIN %s p " \
+			 "ON p.%s = e.%s INNER JOIN %s b ON b.%s = p.%s WHERE b.%s IN (%s)" % \
+			 (qn('track_id'), qn(Enclosure._meta.db_table), qn(Post._meta.db_table),
+			 qn('id'), qn('post_id'), qn(Blog._meta.db_table), qn('feed_id'),
+			 qn('feed_id'), qn('id'), ', '.join(['%s'] * len(ids))), ids)
+			tracks.extend([row[0] for row in cursor.fetchall()])
+		if tracks: stale_tracks().add(tracks)
+		return len(tracks)
+
+	def previous_rank(self):
+		"""The ids and ranks of the last run. If we haven't ranked in
+		this process, we use the ranks stored in the database."""
+		if self.last_ids is not None:
+			return (self.last_ids, self.last_ranks)
+		return self.stored_rank()
+
+	def previous_graph(self):
+		"""The link graph of the last run, from this process, or else
+		from the copy of it kept next to the snapshot. None if there
+		is neither."""
+		if self.last_graph is not None: return self.last_graph
+		path = self.snapshot_path()
+		if path and os.path.exists(path + '.ranked'):
+			return SparseRank.load(path + '.ranked')
+
+	def keep_graph(self, graph):
+		"""Remembers the graph of this run for the next one, also on
+		disk if there is a snapshot."""
+		self.last_graph = graph
+		path = self.snapshot_path()
+		if path: graph.save(path + '.ranked')
+
+	def stored_rank(self, column='rank'):
+		"""The ids and ranks stored in the database, where blogs that
+		have never been ranked have rank 0. column may also be
+		scored_rank."""
+		qn = connection.ops.quote_name
+		ranks = self.__read_columns("SELECT id, %s FROM %s" % \
+		 (qn(column), qn(Blog._meta.db_table)), 2, float64)
+		return (ranks[:,0].astype(int64), ranks[:,1])
+
+	def load_graph(self):
+		"""Reads the link graph from the database, straight in to
+		the arrays of a sparse rank engine."""
+		blogs = self.__read_columns("SELECT id FROM %s" % \
+		 connection.ops.quote_name(Blog._meta.db_table), 1)
+		links = self.__read_columns("SELECT source_id, destination_id FROM %s" % \
+		 connection.ops.quote_name(BlogRelation._meta.db_table), 2)
+		return SparseRank.from_links(blogs[:,0], links[:,0], links[:,1])
+
 	def get_rank(self):
-		"""Calculates the pagerank."""
-		# Get ourself a decent graph
-		if self.invalid:
-			self.normalize_graph()
-		# Find the dominant eigenvector
-		Vn = self.find_dominant(self.normal_matrix)
-		# Process the result afterwards
-		result = [float(x) for x in Vn]
-		indexes = [self.index_to_id[index] for index in range(0,len(result))]
-		result = zip(indexes,result)
-		#print result
-		result.sort(lambda a,b: int(100000*(b[1]-a[1])))
-		self.invalid = False
-		return result
-    
-	def find_dominant(self, A):
-		"""Finds the dominant eigenvector of matrix A.
-		Since no method currently exist in SciPack for iteratively 
-		finding	the dominant eigenvector (wich we know exist), we 
-		calculate it by hand using the power method."""
-		# Start by taking a random guess, we choose (1/n, ..., 1/n)'
-		N = A.shape[0]
-		V = sparse.lil_matrix((1,N))
-		V[0,0:N] = ones((1,N)) * 1/N
-		V = V.transpose()
-		# Iterate until we get sufficient precision
+		"""Calculates the pagerank. Returns the blog ids and their ranks."""
+		return self.load_graph().get_rank()
+
+	def graph(self):
+		"""The link graph. Memory maps the snapshot if there is one,
+		and maps it again whenever it has been rewritten. Without a
+		snapshot, the graph is read from the database once per process."""
+		path = self.snapshot_path()
+		if path and os.path.exists(path):
+			mtime = os.path.getmtime(path)
+			if self.graph_cache is None or mtime != self.graph_mtime:
+				self.invalidate(SparseRank.load(path))
+				self.graph_mtime = mtime
+		elif self.graph_cache is None:
+			self.graph_cache = self.load_graph()
+		return self.graph_cache
+
+	def snapshot_path(self):
+		"""Where the snapshot of the link graph goes, if anywhere."""
+		return getattr(settings, 'GRAPH_SNAPSHOT', None)
+
+	def write_snapshot(self):
+		"""Reads the link graph from the database and saves it as a
+		snapshot, which the rank job and the web views map instead of
+		querying the blog relations. Run after each spider run."""
+		path = self.snapshot_path()
+		if not path: return False
+		graph = self.load_graph()
+		graph.save(path)
+		self.graph_mtime = os.path.getmtime(path)
+		self.invalidate(graph)
+		return True
+
+	def invalidate(self, graph=None):
+		"""Marks the link graph and the personalized ranks computed
+		from it as invalid, optionally replacing the graph."""
+		self.graph_cache = graph
+		self.personal_cache.clear()
+
+	def personalized(self, seeds, weights=None):
+		"""Personalized page rank, where the random surfer teleports
+		to the blogs with ids in seeds, in proportion to weights,
+		instead of to any blog. Returns a list of (blog id, rank)
+		of the highest ranked blogs, best first."""
+		return self.personalized_many([(seeds, weights)])[0]
+
+	def personalized_many(self, seed_sets):
+		"""Personalized page rank for a list of (seeds, weights) pairs,
+		see personalized. Seed sets we haven't seen before are solved
+		together in a single block iteration, and cached. The least
+		recently used seed sets are dropped from the cache."""
+		keys = [self.__seed_key(seeds, weights) for seeds, weights in seed_sets]
+		found = dict([(key, self.personal_cache[key]) for key in uniq(keys) \
+		 if key in self.personal_cache])
+		missing = [key for key in uniq(keys) if not found.has_key(key)]
+		if missing:
+			solved = self.__solve(self.graph(), [([id for id, weight in key], \
+			 [weight for id, weight in key]) for key in missing], \
+			 self.PERSONAL_RESULTS)
+			for key, top in zip(missing, solved):
+				self.personal_cache[key] = found[key] = top
+		return [found[key] for key in keys]
+
+	def write_similar(self, blogs=SIMILAR_BLOGS, batch=SIMILAR_BATCH, \
+	 count=SIMILAR_COUNT):
+		"""Solves the personalized page rank of each of the highest
+		ranked blogs on its own, batch blogs per block iteration, and
+		stores the count best ranked other blogs of each as its similar
+		blogs. All blogs would take a solve each, so only the
+		blogs most likely to be looked at are done; run it after the
+		rank job, if at all."""
+		graph = self.graph()
+		best = list(Blog.objects.order_by('-rank').values_list('id', flat=True)[:blogs])
+		rows = []
+		for ids in chunks(best, batch):
+			solved = self.__solve(graph, [([id], [1.0]) for id in ids], count + 1)
+			for id, top in zip(ids, solved):
+				rows.append((id, ','.join([str(other) for other, rank in top \
+				 if other != id][:count])))
+		update_column(Blog, 'similar', rows)
+		return len(rows)
+	write_similar = transaction.commit_on_success(write_similar)
+
+	def similar_to(self, blog, count=SIMILAR_COUNT):
+		"""Blogs like this one, i.e. the blogs with the highest page
+		rank personalized on this blog. They're read from what
+		write_similar stored, if it did, or else solved and cached
+		per blog, see personalized."""
+		if blog.similar:
+			ids = [int(id) for id in blog.similar.split(',')][:count]
+		else:
+			ids = [id for id, rank in self.personalized([blog.id]) \
+			 if id != blog.id][:count]
+		blogs = Blog.objects.in_bulk(ids)
+		return [blogs[id] for id in ids if blogs.has_key(id)]
+
+	def __solve(self, graph, seed_sets, count):
+		"""Solves the personalized page rank of a list of (ids, weights)
+		seed sets in one block iteration. Returns a list of (blog id,
+		rank) of the count highest ranked blogs, best first, for each
+		seed set; empty for seed sets without any blog we know of."""
+		P, known = graph.teleport(seed_sets)
+		if known.any(): V = graph.personalized(P[:, known])
+		results = []
+		column = 0
+		for has_seeds in known:
+			if not has_seeds:
+				results.append([])
+				continue
+			ranks = V[:, column]
+			column += 1
+			top = (-ranks).argsort()[:count]
+			results.append([(int(graph.ids[i]), float(ranks[i])) \
+			 for i in top if ranks[i] > 0])
+		return results
+
+	def __seed_key(self, seeds, weights):
+		"""A hashable key for a seed set, independent of order."""
+		if weights is None: weights = [1.0] * len(seeds)
+		return tuple(sorted([(int(id), float(weight)) \
+		 for id, weight in zip(seeds, weights)]))
+
+	def __read_columns(self, query, width, dtype=int64):
+		"""Reads a numeric query result in to a (rows, width) array,
+		without keeping a Python object per row."""
+		cursor = connection.cursor()
+		cursor.execute(query)
+		chunks = [zeros((0, width), dtype=dtype)]
 		while True:
-			Vn = self.iterate_once(A,V)
-			if allclose(Vn.todense(), V.todense()): break
-			V = Vn
-		return Vn.todense()
-    
-	def iterate_once(self,A,V):
-		"""Performs one iteration in the power method for approximating
-		an eigenvector."""
-		V =  A * V
-		Vend = float(V[size(V)-1,0])
-		return 1 / Vend * V
+			rows = cursor.fetchmany(self.FETCH_CHUNK)
+			if not rows: break
+			chunks.append(array(rows, dtype=dtype).reshape((len(rows), width)))
+		return concatenate(chunks)
 
 ##############################################################################
 class BlogSpider(models.Manager):
 	"""Manages the spidering of blogs."""
 	MAX_DEPTH = 2
+	# Number of blogs fetched at the same time
+	WORKERS = 8
+	# Number of blogs whose links are built together
+	LINK_BATCH = 500
 
-	def spider_from(self, url):
+	def spider_from(self, url, workers=WORKERS):
 		"""Starts a new spidering, with URL as the center 
 		node of the process."""
 		blog = Blog.manager.find_or_create(url)
-		self.__spider_blog(blog, 1)
+		self.__crawl(blog, workers)
+		Blog.blog_rank.write_snapshot()
 			
-	def build_link_graph(self):
+	def build_link_graph(self, batch=LINK_BATCH):
 		"""Creates the link graph for the random surfer,
-		which we use when we build our pagerank."""
-		blogs = Blog.objects.all()
-		for blog in blogs:
-			blog.update_blog_relations()
-
-	def __spider_blog(self, blog, depth):
-		"""Does the main spidering. Just recurses over 
-		blog rolls until it hits maximal depth."""
-		blogs = blog.index_blog_roll()
-		if depth + 1 > self.MAX_DEPTH: return True
-		for new_blog in blogs:
-			self.__spider_blog(new_blog, depth+1)
+		which we use when we build our pagerank. Blogs are
+		linked a batch at a time."""
+		ids = list(Blog.objects.order_by('id').values_list('id', flat=True))
+		for rows in chunks(ids, batch):
+			BlogRelation.builder.link(Blog.objects.in_bulk(rows).values())
+		Blog.blog_rank.write_snapshot()
+
+	def __crawl(self, blog, workers):
+		"""Does the main spidering. Expands blog rolls breadth first
+		until it hits maximal depth. New blogs are fetched by a pool
+		of workers, while everything touching the database happens
+		here, in a single thread. How many requests run against one
+		host at a time, be it for a page or a feed, is limited by the
+		fetcher (see Fetcher.PER_HOST)."""
+		pool = WorkerPool(lambda (url, depth): Blog.manager.fetch_from_url(url), workers)
+		queued = set()
+		def expand(blog, depth):
+			if depth > self.MAX_DEPTH or not blog.blog_roll: return
+			known = Blog.manager.find_many_fuzzy(blog.blog_roll)
+			for url in blog.blog_roll:
+				if url not in queued and not known.has_key(url):
+					queued.add(url)
+					pool.put((url, depth + 1))
+		try:
+			expand(blog, 1)
+			for (url, depth), fetched, error in pool.results():
+				if error:
+					print "Ingen blogg: %s: %s" % (url, error)
+					continue
+				# A blog that can't be saved or expanded, e.g. because
+				# another process saved it first, is skipped
+				try:
+					if Blog.manager.exists(fetched[0].url):
+						print "Ingen blogg: Dubbelnyckel"
+					else:
+						expand(Blog.manager.save_fetched(*fetched), depth)
+				except Exception, inst:
+					transaction.rollback_unless_managed()
+					Blog.manager.forget(host_key(fetched[0].url))
+					print "Ingen blogg: %s: %s" % (url, inst)
+		finally:
+			pool.close()
 
 ##############################################################################
 class BlogManager(models.Manager):
 	"""Manages creating a new blog, things that strictly don't
-	feel like a blogs responsibility."""
+	feel like a blogs responsibility. Blogs are looked up by their
+	host key, and the (id, url) of the blogs on a host are cached."""
 	
+	# Number of hosts we keep the blogs of in memory
+	CACHE_SIZE = 10000
+	hosts = LRUCache(CACHE_SIZE)
+
 	def create_from_url(self, url):
 		"""Creates a new blog from a URL and does an initial
 		data pull for the blog."""
+		return self.save_fetched(*self.fetch_from_url(url))
+
+	def fetch_from_url(self, url):
+		"""The network half of create_from_url: fetches the blog and
+		its feed without touching the database, so it's safe to run
+		in a worker thread. Returns the unsaved blog and feed."""
 		if not (type(url) == type('s') or type(url) == type(u'u')):
 			raise IllegalBlogException("URL must be valid")
 		urlobj = urlparse(url)
@@ -172,34 +417,88 @@ class BlogManager(models.Manager):
 		url = canonical_url(url)
 		blog = self.model(url=url, title=None, feed=None,\
 		 traversable=False, rank=0.0, html=None)
-		blog.fetch()
+		blog.fetch_page()
+		if not blog.page: raise IllegalBlogException("Empty page " + url)
+		feed = Feed.new_feed.find_from_links(blog.page['feeds'])
+		return (blog, feed)
+
+	def save_fetched(self, blog, feed):
+		"""The database half of create_from_url. The feed and the
+		blog are saved together, or not at all."""
+		feed.save()
+		blog.feed = feed
 		blog.save()
 		return blog
+	save_fetched = transaction.commit_on_success(save_fetched)
 	
 	def exists(self, url):
 		"""True if blog with given URL exists in the database"""
-		objects = Blog.objects.filter(url=canonical_url(url))
-		return len(objects) > 0
+		url = canonical_url(url).lower()
+		return bool([id for id, blog_url in self.on_host(url) \
+		 if blog_url.lower() == url])
 
 	def exists_fuzzy(self, url):
 		"""True if blog with given URL exists in the database"""
-		objects = Blog.objects.filter(url__istartswith=url)
-		if objects: return True
-		else:
-			objects = Blog.objects.filter(url__istartswith=www_url(url))
-			if objects: return True
+		return self.find_id_fuzzy(url) is not None
 
 	def find_by_url(self, url):
-		objects = Blog.objects.filter(url__iexact=url)
-		if objects: return objects[0]
+		for id, blog_url in self.on_host(url):
+			if blog_url.lower() == url.lower():
+				return Blog.objects.get(pk=id)
 
 	def find_by_url_fuzzy(self, url):
 		"""Does a fuzzy search, eg. tries partial matches too."""
-		objects = Blog.objects.filter(url__istartswith=url)
-		if objects: return objects[0]
-		else:
-			objects = Blog.objects.filter(url__istartswith=www_url(url))
-			if objects: return objects[0]		
+		id = self.find_id_fuzzy(url)
+		if id is not None: return Blog.objects.get(pk=id)
+
+	def find_id_fuzzy(self, url):
+		"""The id of the first blog whose URL starts with url, with or
+		without a www, or None."""
+		blogs = self.on_host(url)
+		for prefix in (url.lower(), www_url(url).lower()):
+			for id, blog_url in blogs:
+				if blog_url.lower().startswith(prefix): return id
+
+	def find_many_fuzzy(self, urls):
+		"""Does find_id_fuzzy for a list of URLs, such as a blog roll,
+		reading the hosts we haven't cached in one query. Returns a
+		dict from the URLs that were found to blog ids."""
+		self.cache_hosts([host_key(url) for url in urls])
+		found = {}
+		for url in urls:
+			id = self.find_id_fuzzy(url)
+			if id is not None: found[url] = id
+		return found
+
+	def on_host(self, url):
+		"""The (id, url) of the blogs on the host of url."""
+		key = host_key(url)
+		if key not in self.hosts: self.cache_hosts([key])
+		return self.hosts[key]
+
+	def cache_hosts(self, keys):
+		"""Reads the blogs on the hosts we don't have in the cache."""
+		keys = [key for key in uniq(keys) if key not in self.hosts]
+		for rows in chunks(keys):
+			blogs = dict([(key, []) for key in rows])
+			for id, url, key in Blog.objects.filter(url_key__in=rows) \
+			 .order_by('id').values_list('id', 'url', 'url_key'):
+				blogs[key].append((id, url))
+			for key, on_host in blogs.items(): self.hosts[key] = on_host
+
+	def forget(self, *keys):
+		"""Drops hosts from the cache, when a blog on them is saved or
+		deleted."""
+		for key in keys: self.hosts.pop(key)
+
+	def index_hosts(self):
+		"""Fills in the host key of blogs saved without one."""
+		blogs = Blog.objects.filter(url_key__isnull=True).values_list('id', 'url')
+		count = update_column(Blog, 'url_key', \
+		 [(id, host_key(url)) for id, url in blogs])
+		self.hosts.clear()
+		return count
+	index_hosts = transaction.commit_on_success(index_hosts)
 		
 	def find_or_create(self, url):
 		"""Either creates a new blog or returns the one in the database."""
@@ -211,11 +510,21 @@ class BlogManager(models.Manager):
 class Blog(models.Model):
 	"""Represents a separate blog, i.e. Fluokids or Bigstereo or similarly"""
 	url = models.URLField(unique=True, verify_exists=False, max_length=330)
+	# The host of url, see host_key. Blogs are looked up by it.
+	url_key = models.CharField(max_length=330, null=True, db_index=True)
 	title = models.CharField(max_length=200, null=True, blank=True)
 	feed = models.OneToOneField(Feed, null=True, blank=True)
 	traversable = models.BooleanField(default=False)
 	rank = models.FloatField(default=0.0)
+	# The rank the statistics of the blog's tracks were last queued
+	# with, see BlogRank.write_ranks
+	scored_rank = models.FloatField(default=0.0)
+	# Compressed, and only if settings.KEEP_BLOG_HTML is set
 	html = models.TextField(null=True, blank=True)
+	# What we found on the page at the last fetch, see analyse
+	analysis = models.TextField(null=True, blank=True)
+	# Comma separated ids of similar blogs, see BlogRank.write_similar
+	similar = models.TextField(null=True, blank=True)
 
 	# Standard model manager, for querying etc.
 	objects = models.Manager()
@@ -230,26 +539,47 @@ class Blog(models.Model):
 	blog_rank = BlogRank()
 	
 	# Some private variable we'll use
-	__blog_roll 	= None
+	__page 			= None
 	__data 			= None
 	
+	# The analysed page, a dict with the title, the feed links and the
+	# blog roll. Blogs fetched before we kept it are analysed from the
+	# stored HTML, if there is any.
+	def _get_page(self):
+		if self.__page is None:
+			if self.analysis: self.__page = simplejson.loads(self.analysis)
+			elif self.html: self.analyse()
+		return self.__page
+	page = property(_get_page)
+
 	# Blog roll gives the blog roll for the blog
 	def _get_blog_roll(self):
-		if not self.__blog_roll:
-			if self.data: self.__blog_roll = BlogRoll(self)
-		return self.__blog_roll
+		if self.page: return self.page['blog_roll']
+		return []
 	blog_roll = property(_get_blog_roll)
 	
 	# Gets the souped up data for the blog, or creates 
-	# some if nothing exists.
+	# some if nothing exists. Only there while analysing a page, or
+	# if we kept the HTML.
 	def _get_soup(self):
 		if not self.__data:
-			if self.html: self.__data = BeautifulSoup(self.html)
+			html = self.page_html()
+			if html: self.__data = BeautifulSoup(html)
 		return self.__data
 	data = property(_get_soup)
 
 	def __unicode__(self):
 		return u'%s (%s)' % (self.title, self.url)
+
+	def save(self, *args, **kwargs):
+		old_key = self.url_key
+		self.url_key = host_key(self.url)
+		super(Blog, self).save(*args, **kwargs)
+		Blog.manager.forget(old_key, self.url_key)
+
+	def delete(self):
+		Blog.manager.forget(self.url_key)
+		super(Blog, self).delete()
 	
 	def num_posts(self):
 		return len(self.feed.post_set.all())
@@ -278,17 +608,46 @@ class Blog(models.Model):
 	def fetch(self):
 		"""Fetches a fresh HTML page from the server and updates
 		the URL in case the page has moved."""
+		self.fetch_page()
+		self.__update_feed()
+
+	def fetch_page(self):
+		"""Fetches the HTML page and updates the URL and title, but
+		leaves the feed alone."""
 		html, url = get_data_from_url(self.url)
 		if url: self.url = url
-		if html: self.html = html
-		self.__update_title()
-		self.__update_feed()
+		if html: self.analyse(html)
+
+	def analyse(self, html=None):
+		"""Parses the page, once, and keeps what we need from it: the
+		title, the feed links and the blog roll. Analyses the stored
+		HTML unless given the HTML of a fresh fetch."""
+		if html:
+			self.__data = BeautifulSoup(html)
+			if getattr(settings, 'KEEP_BLOG_HTML', False):
+				self.html = pack_text(html)
+			else: self.html = None
+		soup = self.data
+		if not soup: return
+		self.__page = {'title': self.__find_title(soup),
+		 'feeds': Feed.new_feed.feed_links(soup),
+		 'blog_roll': BlogRoll(self).possible_blog_rolls()}
+		self.analysis = simplejson.dumps(self.__page)
+		# The soup is many times the size of the page, don't hold on to it
+		self.__data = None
+		if self.__page['title']: self.title = self.__page['title']
+
+	def page_html(self):
+		"""The stored HTML of the page, if we kept it. Pages stored
+		before we compressed them are plain HTML."""
+		return unpack_text(self.html) or None
 
 	def index_blog_roll(self):
 		"""Indexes the entire blog roll in to our index."""
 		new_blogs = []
+		known = Blog.manager.find_many_fuzzy(self.blog_roll)
 		for blog_url in self.blog_roll:
-			if not Blog.manager.exists_fuzzy(blog_url):
+			if not known.has_key(blog_url):
 				try:
 					bl = Blog.manager.create_from_url(blog_url)
 				except IllegalBlogException, inst: 
@@ -304,19 +663,7 @@ class Blog(models.Model):
 		"""Creates all the outgoing links from this blog, as 
 		given by the blog roll. Should be run _after_ the blog
 		roll has been indexed."""
-		# First, clean out the old shit
-		#relations = BlogRelation.objects.filter(source=self)
-		#[rel.delete() for rel in relations]
-		# Then just iterate over the blog roll and links
-		# to blogs already in the database.
-		for url in self.blog_roll:
-			blog = Blog.manager.find_by_url_fuzzy(url)
-			if blog:
-				try:
-					rel = BlogRelation(source=self,destination=blog)
-					rel.save()
-				except: 
-					continue					
+		return BlogRelation.builder.link([self])
 				
 	def common_artists(self):
 		posts = self.feed.post_set.all()
@@ -335,20 +682,17 @@ class Blog(models.Model):
 			pops = pops[:5]
 		return pops
 
-	def __update_title(self):
-		"""Updates the title. Do not call directly."""
-		if not self.data: return
-		if self.data.find('title'): 
-			title = self.data.find('title').string
-			if len(title) > 200:
-				title = title[0:199]
-			self.title = title
-			return True
+	def __find_title(self, soup):
+		"""Finds the title of a page. Do not call directly."""
+		title = soup.find('title')
+		if title and title.string:
+			return unicode(title.string)[0:199]
     
 	def __update_feed(self):
 		"""Updates the feed. Do not call directly."""
+		if not self.page: return
 		self.feed = \
-		 Feed.new_feed.update_or_create(self.feed, self.data)
+		 Feed.new_feed.update_or_create(self.feed, self.page['feeds'])
 
 	# Admin stuff
 	class Admin:
@@ -374,12 +718,16 @@ class BlogRoll(object):
 	# want to discard archive pages and similarly.
 	TOO_POPULAR = ['http://(www\.)?myspace.com',\
 	 'http://(www\.)?last.fm.*','http://(www\.)?hypem.com.*',\
-	 'http://hype.non-standard.net/.*','.*wikipedia.org.*'\
+	 'http://hype.non-standard.net/.*','.*wikipedia.org.*',\
 	 'http://(www\.)?pitchforkmagazine.com.*',\
 	 'http://(www\.)?thefader.com.*','http://(www\.)?scissorkick.com/.*',\
 	 'http://(www\.)?talk2action.org/.*','http://(www\.)?cableandtweed.blogspot.com/',\
 	 'http://([a-z0-9_-])?.blogspot.com/(.+)_archive.html']
 
+	# Both lists compiled in to single matchers, once per process
+	REJECTED = UrlClassifier(REJECTABLES)
+	POPULAR = UrlClassifier(TOO_POPULAR)
+
 	def __init__(self, blog):
 		self.blog = blog
 
@@ -390,16 +738,12 @@ class BlogRoll(object):
 		if re.match('http://www.*', self.url):
 			pageUrlWww = re.sub('^http://www\.', "http://", self.url)
 		else:
-			pageUrlWww = re.sub('^http://', "http://www\.", self.url)
+			pageUrlWww = re.sub('^http://', "http://www.", self.url)
         
  		# We should really extract these in to the database, 
 		# turn blog roll in to a manager of these and let it operate
 		# on a blog. That'd be nifty.
-		blocks = [self.url, pageUrlWww] + self.REJECTABLES
-		popsites = [self.url, pageUrlWww] + self.TOO_POPULAR
-		
-		self.blockexp = [re.compile(b, re.IGNORECASE) for b in blocks]
-		self.popsites = [re.compile(b, re.IGNORECASE) for b in popsites]
+		self.own_urls = (self.url.lower(), pageUrlWww.lower())
 
 	__blog_roll = None
 	
@@ -419,7 +763,7 @@ class BlogRoll(object):
 		nests = [x for x in self.data.findAll({'p': True, 'div': True}) \
 		 if x.findAll('ul',recursive=False)]
 		list = self.reject_pop_sites(uniq(flatten(self.link_lists(nests))))
-		return [canonical_url(site) for site in list]
+		return canonical_urls(list)
     
 	def link_lists(self,lists):
 		"""Returns true if `lists' contains a link list
@@ -436,18 +780,39 @@ class BlogRoll(object):
     
 	def anchor_cluster_list(self, div):
 		"""Finds places that are "anchor clusters", in the sense that
-		they have a high ratio of anchor tags to other data
-		Pretty intensive on calculations, very unoptimized"""
-		atags = div.findAll('a')
+		they have a high ratio of anchor tags to other data. The markup
+		is measured once, and each parent of an anchor looked at once."""
+		sizes = self.markup_sizes(div)
 		visited = set()
 		link_list = []
-		for anchor in atags:
-			if anchor.has_key('href') and anchor.parent.contents and \
-			 str(anchor.parent.contents) not in visited:
-				visited.add(str(anchor.parent.contents))
-				links = self.links_from_anchors(anchor.parent)
+		for anchor in div.findAll('a', href=True):
+			if id(anchor.parent) not in visited:
+				visited.add(id(anchor.parent))
+				links = self.links_from_anchors(anchor.parent, sizes)
 				if links: link_list.extend(links)
 		return link_list
+
+	def markup_sizes(soup):
+		"""Measures the markup of soup and every node below it, i.e.
+		len(str(node)), in a single bottom up pass. Returns a dict
+		keyed by the id of the node."""
+		sizes = {}
+		stack = [(soup, False)]
+		while stack:
+			node, seen = stack.pop()
+			if not isinstance(node, Tag):
+				sizes[id(node)] = len(str(node))
+			elif seen:
+				# The tag itself, without its contents
+				contents, node.contents = node.contents, []
+				try: size = len(str(node))
+				finally: node.contents = contents
+				sizes[id(node)] = size + sum([sizes[id(c)] for c in contents])
+			else:
+				stack.append((node, True))
+				stack.extend([(c, False) for c in node.contents])
+		return sizes
+	markup_sizes = staticmethod(markup_sizes)
     
 	def unordered_link_list(self, list):
 		"""Looks for linked lists in the <ul>-sense of being unordered
@@ -455,13 +820,15 @@ class BlogRoll(object):
 		return [x for x in [self.linked_list(li) \
 		 for li in list.findAll('ul')] if x]
     
-	def links_from_anchors(self, aParent):
+	def links_from_anchors(self, aParent, sizes=None):
 		"""Tries to find a links by scanning the parent of an anchor
-		tag that might be part of a cluster."""
+		tag that might be part of a cluster. sizes are the markup
+		sizes of the page, see markup_sizes."""
 		anchors = aParent.findAll('a', recursive = False)
 		if len(anchors) > 5:
-			blockSize = sum([len(str(a)) for a in aParent.contents])
-			anchorSize = sum([len(str(a)) for a in anchors])
+			if sizes is None: sizes = self.markup_sizes(aParent)
+			blockSize = sum([sizes[id(a)] for a in aParent.contents])
+			anchorSize = sum([sizes[id(a)] for a in anchors])
 			if (1.0*anchorSize)/blockSize > 0.9:
 				valid_list = [x['href'] for x in anchors \
 			 	 if x.has_key('href') and self.valid_href(x['href'])]
@@ -504,8 +871,8 @@ class BlogRoll(object):
 		# First check we're moving to another site
 		if not re.match('^http://',href): return None
 		# Then check that we're not going to a bad site
-		blocks = [True for x in self.blockexp if x.match(href)]
-		if not blocks: return href
+		if not (self.is_own_url(href) or self.REJECTED.match(href)):
+			return href
     
 	def reject_pop_sites(self, list):
 		"""Rejects popular sites that likely are unrelated to what we're
@@ -515,13 +882,55 @@ class BlogRoll(object):
 	def is_pop_site(self, url):
 		"""Does a simple regular expression match to decide if a site is
 		a popular site."""
-		return [True for x in self.popsites if x.match(url)]
+		return self.is_own_url(url) or self.POPULAR.match(url)
+
+	def is_own_url(self, url):
+		"""Checks if a URL points back in to the blog itself."""
+		return url.lower().startswith(self.own_urls)
     
+##############################################################################
+class RelationBuilder(models.Manager):
+	"""Builds the links of the blog graph from blog rolls, a batch of
+	blogs at a time."""
+
+	def link(self, blogs):
+		"""Makes the outgoing links of blogs match their blog rolls, as
+		far as the blogs in them are in the database. Only the missing
+		links are inserted, and links no longer in a blog roll deleted.
+		Blogs we haven't got a page for keep their links. Returns the
+		number of links added and removed."""
+		rolls = dict([(blog.id, blog.blog_roll) for blog in blogs if blog.page])
+		if not rolls: return (0, 0)
+		urls = []
+		for roll in rolls.values(): urls.extend(roll)
+		known = Blog.manager.find_many_fuzzy(uniq(urls))
+		wanted = set()
+		for source, roll in rolls.items():
+			wanted.update([(source, known[url]) for url in roll \
+			 if known.has_key(url)])
+		existing = {}
+		for source_ids in chunks(rolls.keys()):
+			for id, source, destination in \
+			 BlogRelation.objects.filter(source__in=source_ids) \
+			 .values_list('id', 'source', 'destination'):
+				existing[(source, destination)] = id
+		missing = sorted([link for link in wanted if not existing.has_key(link)])
+		stale = [id for link, id in existing.items() if link not in wanted]
+		insert_rows(BlogRelation, ['source_id', 'destination_id'], missing)
+		delete_rows(BlogRelation, stale)
+		return (len(missing), len(stale))
+	link = transaction.commit_on_success(link)
+
 ##############################################################################
 class BlogRelation(models.Model):
 	"""A directional link between two blogs in our graph.
 	Backlinks are given by related_name."""
 	source = models.ForeignKey(Blog, related_name = 'target_of')
 	destination = models.ForeignKey(Blog, related_name = 'source_of')
+
+	objects = models.Manager()
+	# Builds the links from blog rolls
+	builder = RelationBuilder()
+
 	class Meta:
 		unique_together = (("source", "destination"),)
@@ -44,4 +44,6 @@ def details(request, blog_id):
 	"""Information about a certain blog"""
 	blog = Blog.objects.filter(id=blog_id)
 	blog = blog[0]
-	return render_to_response('blogs_details.html', {'blog': blog})
\ No newline at end of file
+	similar = Blog.blog_rank.similar_to(blog)
+	return render_to_response('blogs_details.html', \
+	 {'blog': blog, 'similar': similar})
\ No newline at end of file
@@ -2,11 +2,18 @@ import feedparser
 import urllib2
 import re
 import datetime
+import calendar
+from email.Utils import formatdate, parsedate
 from BeautifulSoup import BeautifulSoup, SoupStrainer
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from zoid.music.models import Track
-from zoid.helpers.utils import canonical_url, uniq, flatten
+from zoid.helpers.utils import canonical_url, uniq, flatten, anchor_hrefs
+from zoid.helpers.fetch import fetcher, FetchError
+from zoid.helpers.pool import imap_unordered
+from zoid.helpers.urlclass import UrlClassifier
+from zoid.helpers.bulk import insert_rows, delete_rows, chunks
 
 ##############################################################################
 class IllegalFeedException(Exception):
@@ -18,60 +25,122 @@ class IllegalFeedException(Exception):
 	def __str__(self):
 		return self.str
 
+##############################################################################
+def stale_tracks():
+	"""The queue of tracks whose statistics are out of date, see
+	StaleQueue. Statistics imports us, hence the late import."""
+	from zoid.statistics.models import StaleTrack
+	return StaleTrack.queue
+
 ##############################################################################
 class FeedUpdater(models.Manager):
 	"""Manages refreshing feeds and fetching hot new music."""
 	
-	def update(self):
-		feeds = Feed.feeds.all()
-		for feed in feeds:
+	# Number of feeds fetched at the same time
+	WORKERS = 8
+	
+	def update(self, workers=WORKERS):
+		"""Refreshes the feeds that are due for a poll. The feeds are
+		fetched by a pool of workers, while posts are written here, in
+		a single thread. Returns a dict counting the feeds that had
+		changed, that hadn't (304s), that failed, and the bytes we
+		downloaded. Afterwards, the statistics of the tracks that were
+		queued as stale are recomputed, and only those."""
+		stats = {'modified': 0, 'not_modified': 0, 'failed': 0, 'bytes': 0}
+		for feed, response, error in \
+		 imap_unordered(lambda feed: feed.fetch(), self.due(), workers):
 			print "== Refreshing " + feed.url
-			feed.update()
+			if error: print "Cannot fetch feed: %s" % (error)
+			# A feed we can't apply is backed off, like one we can't
+			# fetch, instead of ending the refresh
+			try: feed.refresh(response)
+			except Exception, inst:
+				transaction.rollback_unless_managed()
+				print "Cannot refresh feed: %s: %s" % (feed.url, inst)
+				feed.back_off()
+				response = None
+			self.count(stats, response)
+		print "Refreshed %(modified)d feeds, %(not_modified)d not modified, " \
+		 "%(failed)d failed, %(bytes)d bytes" % stats
+		# Tracks are also queued when blog ranks change, so the queue
+		# is worked off even if no feed changed
+		stats['stale'] = stale_tracks().update_stale()
+		return stats
+
+	def due(self):
+		"""The feeds whose next poll is due, or that were never polled."""
+		return Feed.feeds.filter(Q(next_poll__isnull=True) | \
+		 Q(next_poll__lte=datetime.datetime.now()))
+
+	def count(self, stats, response):
+		"""Adds the response of a feed refresh to the stats."""
+		if not response or response.status not in (200, 304):
+			stats['failed'] += 1
+			return
+		if response.status == 304: stats['not_modified'] += 1
+		else: stats['modified'] += 1
+		stats['bytes'] += len(response.body)
 		
 
 ##############################################################################
 class NewFeedManager(models.Manager):
 	"""Manages the creation of new feeds"""
 
-	def update_or_create(self, current_feed, soup):
+	# The feed types we look for, most preferred first
+	FEED_TYPES = ['application/atom+xml', 'application/rss+xml', 'text/xml']
+
+	def update_or_create(self, current_feed, links):
 		"""Does the right thing, i.e. creates a new feed object 
-		if required, or returns the current one if not."""
+		if required, or returns the current one if not. links are
+		the feed links of the blog, see feed_links."""
 		if not current_feed:
-			return self.find_and_create_from_soup(soup)
-		new_feed_url = self._feed_url(soup)
+			return self.find_and_create_from_links(links)
+		new_feed_url = self.__feed_url(links)
 		if new_feed_url and new_feed_url != current_feed.url:
 			current_feed.delete()
 			return self.create_from_url(new_feed_url)
 		return current_feed
 
-	def find_and_create_from_soup(self, soup):
-		"""Finds a feed in parsed HTML and creates it"""
-		feed_url = self.__feed_url(soup)
+	def find_and_create_from_links(self, links):
+		"""Finds a feed among the feed links of a page and creates it"""
+		feed = self.find_from_links(links)
+		feed.save()
+		return feed
+
+	def find_from_links(self, links):
+		"""Finds a feed among the feed links of a page and checks it
+		for music, but doesn't save it."""
+		feed_url = self.__feed_url(links)
 		if feed_url:
-			return self.create_from_url(feed_url)
+			return self.from_url(feed_url)
 		else:
 			raise IllegalFeedException("No feed found for blog.")
 
 	def create_from_url(self, url):
 		"""Fetches a feed from a URL and creates a feed object."""
+		feed = self.from_url(url)
+		feed.save()
+		return feed
+
+	def from_url(self, url):
+		"""Fetches a feed from a URL and checks it for music."""
 		feed = self.model(url=url, etag=None, modified=None)
 		feed.detect_music()
-		feed.save()
 		return feed
 
-	def __feed_url(self, soup):
+	def feed_links(self, soup):
+		"""Finds the feed links of a parsed HTML page, as a list of
+		(type, href) pairs in page order."""
+		return [(link['type'], link['href']) for link in \
+		 soup.findAll('link', rel='alternate', type=self.FEED_TYPES, href=True)]
+
+	def __feed_url(self, links):
 		"""Tries to locate the URL of a feed, first checks for an Atom
 		feed, and then checks for an RSS feed. Pretty simple logic, so
 		will probably break down in fringe cases."""
-		atom_feed = soup.find('link',rel='alternate', \
-		 type='application/atom+xml')
-		if atom_feed: return atom_feed['href']
-		rss_feed = soup.find('link',rel='alternate', \
-		 type='application/rss+xml')
-		if rss_feed: return rss_feed['href']
-		xml_feed = soup.find('link', rel='alternate', \
-		 type='text/xml')
-		if xml_feed: return xml_feed['href']
+		for feed_type in self.FEED_TYPES:
+			for link_type, href in links:
+				if link_type == feed_type: return href
 
 
 ##############################################################################
@@ -80,36 +149,44 @@ class Feed(models.Model):
 	url = models.URLField(verify_exists=False, max_length=500)
 	etag = models.CharField(max_length=150, null=True, blank=True)
 	modified = models.DateTimeField(null=True, blank=True)
+	# Polling schedule. The interval is in seconds, and adapts to how
+	# often the feed has new posts and how often it answers 304.
+	next_poll = models.DateTimeField(null=True, blank=True, db_index=True)
+	poll_interval = models.IntegerField(default=3600)
+	polls = models.IntegerField(default=0)
+	not_modified = models.IntegerField(default=0)
 
 	feeds = models.Manager()
 	new_feed = NewFeedManager()
 	updater = FeedUpdater()
-	_providers = None
+
+	# Bounds of the poll interval, in seconds
+	MIN_POLL = 15 * 60
+	MAX_POLL = 24 * 60 * 60
+	# Polls per average time between posts
+	POLLS_PER_POST = 2
+	# Posts we look at for the average time between posts
+	POST_HISTORY = 10
+
+	# Where get_mp3_links caches the links of an entry
+	LINKS_KEY = 'gossip_mp3_links'
 
 	MUSIC_PROVIDERS = [".*zshare\.net.*",".*yousendit\.com.*",\
 		".*speedyshare\.com.*",".*?\.mp3$"]
+	# URLs we suspect contain music, compiled once per process
+	MUSIC_LINKS = UrlClassifier(MUSIC_PROVIDERS)
 		
 	def __unicode__(self):
 		return self.url
 	#	return self.blog.
 
-	def _get_music_providers(self):
-		"""The music providers property, containing information about
-		URLs we suspect contain music."""
-		if not self._providers:
-			self._providers = \
-			 [re.compile(l, re.IGNORECASE) for l in self.MUSIC_PROVIDERS]
-		return self._providers
-
-	music_providers = property(_get_music_providers)
-	
 	def title(self):
 		try: return self.blog.title
 		except: return self.url
 
 	def detect_music(self):
 		"""Tries to detect if a feed contains any music."""
-		try: self.feed = feedparser.parse(self.url)
+		try: self.feed = feedparser.parse(fetcher.fetch(self.url).body)
 		except: raise IllegalFeedException("Cannot find feed")
 		if not self.is_mp3_feed():
 			raise IllegalFeedException("Not a feed for an MP3 blog")
@@ -136,42 +213,123 @@ class Feed(models.Model):
 
 	def update(self):
 		"""Updates the current feed by trying to fetch a new one, and then
-		iterating over the feeds."""
-		feed = feedparser.parse(self.url)
-		#feed = feedparser.parse(self.url, \
-		# modified=self.modified, etag=self.etag)
-		if feed.has_key('status'):
-			if feed.status in [200, 301, 302, 307]:
-				# Permanent redirect, update URL
-				if feed.status == 301: self.url = feed.url
-				if feed.has_key('updated_parsed'):
-					self.feed_updated = feed['updated_parsed']
-				# We probably have new contents
-				for entry in feed.entries:
-					self.update_post(entry)
+		iterating over the feeds. Returns the response, if any."""
+		response = self.fetch()
+		self.refresh(response)
+		return response
+
+	def refresh(self, response):
+		"""Applies a fetched response, schedules the next poll and saves."""
+		self.apply(response)
+		self.schedule(response)
+		self.save()
+
+	def fetch(self):
+		"""Fetches the feed, unless it hasn't changed since the last time,
+		in which case we get an empty 304. Returns None if we couldn't
+		fetch it at all."""
+		headers = {}
+		if self.etag: headers['If-None-Match'] = self.etag
+		if self.modified:
+			headers['If-Modified-Since'] = \
+			 formatdate(calendar.timegm(self.modified.timetuple()), usegmt=True)
+		try: return fetcher.fetch(self.url, headers)
+		except FetchError, inst:
+			print "Cannot fetch feed: %s" % (inst)
+
+	def apply(self, response):
+		"""Updates the posts from a fetched feed, and keeps the
+		validators we'll send next time."""
+		if not response: return
+		if response.status == 304: return
+		if response.status == 200:
+			# Permanent redirect, update URL
+			if response.permanent: self.url = response.url
+			self.etag = response.headers.get('etag')
+			if self.etag and len(self.etag) > 150: self.etag = None
+			self.modified = None
+			if response.headers.has_key('last-modified'):
+				modified = parsedate(response.headers['last-modified'])
+				if modified: self.modified = datetime.datetime(*modified[:6])
+			feed = feedparser.parse(response.body)
+			if feed.has_key('updated_parsed'):
+				self.feed_updated = feed['updated_parsed']
+			# We probably have new contents. The tracks of all the
+			# entries are found, or created, at once.
+			songs = [self.__songs(entry) for entry in feed.entries]
+			pairs = []
+			for entry_songs in songs:
+				pairs.extend([(artist, title) for artist, title, href in entry_songs])
+			tracks = iter(Track.resolver.resolve(pairs))
+			posts = [self.__post(entry, \
+			 [(tracks.next(), href) for artist, title, href in entry_songs]) \
+			 for entry, entry_songs in zip(feed.entries, songs)]
+			Post.from_feed.ingest(self, posts)
+		else:
+			print "Odd feed status: %d" % (response.status)
+
+	def schedule(self, response):
+		"""Sets the time of the next poll. We aim for POLLS_PER_POST polls
+		per average time between the latest posts, and back off in
+		proportion to how often the feed has answered 304. Failures
+		double the interval."""
+		self.polls += 1
+		if response and response.status == 304: self.not_modified += 1
+		if not response or response.status not in (200, 304):
+			interval = 2 * self.poll_interval
+		else:
+			dates = list(self.post_set.filter(published__isnull=False) \
+			 .order_by('-published').values_list('published', flat=True) \
+			 [:self.POST_HISTORY])
+			if len(dates) > 1:
+				gap = dates[0] - dates[-1]
+				gap = (gap.days * 86400 + gap.seconds) / (len(dates) - 1)
+				interval = gap / self.POLLS_PER_POST
 			else:
-				print "Odd feed status: %d" % (feed.status)
+				interval = self.MAX_POLL
+			interval *= 1.0 + float(self.not_modified) / self.polls
+		self.poll_interval = int(min(max(interval, self.MIN_POLL), self.MAX_POLL))
+		self.next_poll = datetime.datetime.now() + \
+		 datetime.timedelta(seconds=self.poll_interval)
+
+	def back_off(self):
+		"""Schedules the next poll as after a failed fetch. Only the
+		schedule is saved, not whatever a failed refresh left behind,
+		such as the validators of a response we couldn't apply."""
+		self.schedule(None)
+		Feed.feeds.filter(id=self.id).update(polls=self.polls, \
+		 poll_interval=self.poll_interval, next_poll=self.next_poll)
 
 	def update_post(self, entry):
 		"""Updates a single (as of now unknown) post from a feed."""
+		return Post.from_feed.ingest(self, \
+		 [self.__post(entry, self.__enclosure_list(entry))])
+
+	blog_url = None
+
+	def __post(self, entry, files):
+		"""The (title, url, date, files) of an entry, see
+		PostCreator.ingest."""
 		title, url, date = self.__entry_meta(entry)
-		files = self.__enclosure_list(entry)
-		if not url: url = self.blog.url
-		post = Post.from_feed.create_or_update(self, title, url, date, files)
+		if not url:
+			if not self.blog_url: self.blog_url = self.blog.url
+			url = self.blog_url
+		return (title, url, date, files)
 
 	def get_mp3_links(self, entry):
-		"""Gets the MP3 links from a post."""
+		"""Gets the MP3 links from a post. The links are cached on the
+		entry, so checking and updating the same entry parses it once."""
+		if entry.has_key(self.LINKS_KEY): return entry[self.LINKS_KEY]
 		mp3_links = []
 		# First gather contents
 		contents = []
 		if entry.has_key('content'): contents.extend(entry['content'])
 
+		# Content and summary are often the same HTML, so we keep
+		# the links of each piece of HTML we've looked at
+		parsed = {}
 		for content in contents:
-			code = BeautifulSoup(content.value)
-			mp3_links.extend([song_obj(a) \
-			for a in code.findAll('a') \
-			if a.has_key('href') and vars(a).has_key('string') and \
-			 self.is_mp3_link(a['href'])])
+			mp3_links.extend(self.__html_mp3_links(content.value, parsed))
 
 		# Then gather from the links
 		if entry.has_key('links'):
@@ -184,18 +342,32 @@ class Feed(models.Model):
 		# If we don't have anything, check the extended summary
 		if not mp3_links and entry.has_key('summary_detail'): 
 			content = entry['summary_detail']
-			code = BeautifulSoup(content.value)
-			mp3_links.extend([song_obj(a) \
-			 for a in code.findAll('a') \
-			 if a.has_key('href') and vars(a).has_key('string') and \
-			  self.is_mp3_link(a['href'])])
+			mp3_links.extend(self.__html_mp3_links(content.value, parsed))
 			
 		# ...and done!
+		entry[self.LINKS_KEY] = mp3_links
 		return mp3_links
 
+	def __html_mp3_links(self, html, parsed):
+		"""Gets the MP3 links from a piece of HTML. Most posts don't link
+		to any music at all, so we first scan the hrefs of the <a> tags
+		with a regular expression, and only build a tree, once, for HTML
+		that does. The tree is needed since the song heuristics look at
+		the text around the links."""
+		if not parsed.has_key(html):
+			if not [h for h in anchor_hrefs(html) if self.is_mp3_link(h)]:
+				parsed[html] = []
+			else:
+				code = BeautifulSoup(html)
+				parsed[html] = [song_obj(a) \
+				 for a in code.findAll('a', href=True) \
+				 if vars(a).has_key('string') and self.is_mp3_link(a['href'])]
+		return parsed[html]
+
 	def is_mp3_link(self, link):
-		"""Checks if a link points to an MP3 file"""
-		return [True for host in self.music_providers if host.match(link)]
+		"""Checks if a link points to an MP3 file. Returns the
+		music provider pattern it matched, if any."""
+		return self.MUSIC_LINKS.match(link)
 
 	def __entry_meta(self, entry):
 		"""Gets the title, link and date"""
@@ -215,24 +387,25 @@ class Feed(models.Model):
 			return datetime.datetime(*self.feed_updated[:6])
 
 	def __enclosure_list(self, entry):
-		links = self.get_mp3_links(entry)
-		encl=[]
-		for link in links:
+		"""The (track id, url) of the enclosures of an entry."""
+		songs = self.__songs(entry)
+		tracks = Track.resolver.resolve([(artist, title) \
+		 for artist, title, href in songs])
+		# Earlier, we only added tracks we didn't already have,
+		# but I find this more natural. If someone double-posts
+		# something, we should notice it.
+		return [(track, href) for track, (artist, title, href) in zip(tracks, songs)]
+
+	def __songs(self, entry):
+		"""The (artist, title, url) of the songs linked from an entry."""
+		songs = []
+		for link in self.get_mp3_links(entry):
 			artist = ''
 			if link.has_key('artist'): artist = link['artist']
 			if link.has_key('title'): title = link['title']
 			else: title = link['string']
-			if title:
-				track = Track.track_manager.find_or_create(artist,title)
-				encl.append([track,link['href']])
-				# Earlier, we only added tracks we didn't already have,
-				# but I find this more natural. If someone double-posts
-				# something, we should notice it.
-				# Old code below for reference:
-				#already_got = self.post_set.filter(enclosure__track=track)
-				#if not already_got: 
-			
-		return encl
+			if title: songs.append((artist, title, link['href']))
+		return songs
 
 ############################################################################
 # Parsing routines for link names.
@@ -367,31 +540,94 @@ class PostCreator(models.Manager):
 		"""Either returns a post matching the criteria, or create
 		a new one, giving it.
 		
-		Notice that the parameter ``file'' is of the sort (Track, url)
+		Notice that the parameter ``file'' is of the sort (track id, url)
 		"""
-		post = Post.objects.filter(url=my_url)
-		if post:
-
-			if post[0].published > date: 
-				print my_url
-				return post[0]
-			else:
-				enclosures=post[0].enclosure_set.all()
-				for e in enclosures: e.delete()
-				post.delete()
-		
-		if date:
-			new_post = self.model(feed=my_feed, title=title,url=my_url,published=date)
-		else:
-			new_post = self.model(feed=my_feed, title=title,url=my_url)
-		print "I've made it this far!"
-		new_post.save()
-		if files:
-			for file in files:
-				e = Enclosure(post=new_post, track=file[0],url=file[1]) 
-				try: e.save()
-				except: pass
-		return post
+		self.ingest(my_feed, [(title, my_url, date, files)])
+		return Post.objects.get(url=my_url)
+
+	def ingest(self, feed, entries):
+		"""Brings the posts of a feed in line with its entries, a list of
+		(title, url, date, files) as in create_or_update. Posts are
+		matched on URL: new ones are inserted, and the ones that have
+		changed, or whose enclosures have, updated in place. Posts we
+		have a later version of are left alone. The tracks whose
+		statistics this changes are queued, see StaleTrack. Returns the
+		number of posts inserted and updated."""
+		length = Post._meta.get_field('title').max_length
+		# Later entries with the same URL win, unless they're older
+		wanted = {}
+		for title, url, date, files in entries:
+			if not (wanted.has_key(url) and later(wanted[url][1], date)):
+				wanted[url] = (title and title[:length], date, files)
+		existing = {}
+		for urls in chunks(wanted.keys()):
+			for id, url, title, published, feed_id in Post.objects \
+			 .filter(url__in=urls).values_list('id', 'url', 'title', 'published', 'feed'):
+				existing[url] = (id, title, published, feed_id)
+
+		new, updated, moved, synced = [], set(), set(), {}
+		for url, (title, date, files) in wanted.items():
+			if not existing.has_key(url):
+				new.append((feed.id, title, url, date))
+				continue
+			id, old_title, published, feed_id = existing[url]
+			if later(published, date): continue
+			if (old_title, published, feed_id) != (title, date, feed.id):
+				Post.objects.filter(pk=id).update(title=title, published=date, feed=feed)
+				updated.add(id)
+			# The statistics of its tracks depend on these
+			if (published, feed_id) != (date, feed.id): moved.add(id)
+			synced[id] = files
+		changed, stale = self.__sync_enclosures(synced, moved)
+		updated.update(changed)
+		insert_rows(Post, ['feed_id', 'title', 'url', 'published'], new)
+		inserted = {}
+		for urls in chunks([url for feed_id, title, url, date in new]):
+			for id, url in Post.objects.filter(url__in=urls).values_list('id', 'url'):
+				inserted[id] = wanted[url][2]
+		stale.update(self.__sync_enclosures(inserted)[1])
+		if stale: stale_tracks().add(stale)
+		return (len(new), len(updated))
+	ingest = transaction.commit_on_success(ingest)
+
+	def __sync_enclosures(self, posts, moved=()):
+		"""Makes the enclosures of posts, a dict from post id to files,
+		match the files. A post has one enclosure per track, the first
+		one. Returns the ids of the posts whose enclosures changed, and
+		the tracks that were added or removed, or that belong to the
+		moved posts."""
+		wanted = {}
+		for post, files in posts.items():
+			for track, url in files or []:
+				if not wanted.has_key((post, track)): wanted[(post, track)] = url
+		existing = {}
+		for ids in chunks(posts.keys()):
+			for id, post, track, url in Enclosure.objects.filter(post__in=ids) \
+			 .values_list('id', 'post', 'track', 'url'):
+				existing[(post, track)] = (id, url)
+		changed, tracks = set(), set()
+		stale = []
+		for (post, track), (id, url) in existing.items():
+			if not wanted.has_key((post, track)):
+				stale.append(id)
+				changed.add(post)
+				tracks.add(track)
+			elif wanted[(post, track)] != url:
+				Enclosure.objects.filter(pk=id).update(url=wanted[(post, track)])
+				changed.add(post)
+			if post in moved: tracks.add(track)
+		new = [(post, track, url) for (post, track), url in wanted.items() \
+		 if not existing.has_key((post, track))]
+		changed.update([post for post, track, url in new])
+		tracks.update([track for post, track, url in new])
+		delete_rows(Enclosure, stale)
+		insert_rows(Enclosure, ['post_id', 'track_id', 'url'], new)
+		return (changed, tracks)
+
+def later(first, second):
+	"""True if the date first is later than second, where a missing
+	date is earlier than any other."""
+	return first is not None and (second is None or first > second)
 
 ##############################################################################
 class Post(models.Model):
@@ -0,0 +1,77 @@
+"""
+benchmarks.py
+
+Micro-benchmarks for the URL helpers in utils, against the way they used
+to be. The input is 100k blog roll links, many of them repeated, as they
+are over a crawl.
+
+	python benchmarks.py [links]
+"""
+import re
+import sys
+import time
+import random
+
+from zoid.helpers import utils
+
+def old_canonical_url(url):
+	match = re.match("(.+?)/index.htm(l)?", url)
+	if match: url = match.group(1)
+	match = re.match("^(http://([^/]+)?)(/$|$)", url)
+	if match: url = match.group(1)
+	match = re.match("^http://www\.(.+)", url)
+	if match: url = 'http://' + match.group(1)
+	return url
+
+def old_flatten(L):
+	if type(L) != type([]): return [L]
+	if L == []: return L
+	return old_flatten(L[0]) + old_flatten(L[1:])
+
+def links(count, distinct):
+	"""count links to distinct blogs, in blog rolls of 50."""
+	random.seed(count)
+	blogs = []
+	for i in range(distinct):
+		blogs.append(random.choice(['http://www.blog%d.com/',
+		 'http://blog%d.blogspot.com/', 'http://blog%d.net/index.html',
+		 'http://www.music%d.org/blog/']) % i)
+	urls = [random.choice(blogs) for i in range(count)]
+	return [urls[i:i+50] for i in range(0, count, 50)]
+
+def timed(name, count, func, *args):
+	start = time.time()
+	func(*args)
+	spent = time.time() - start
+	print "%-34s %8.3fs %10d/s" % (name, spent, count / max(spent, 1e-6))
+	return spent
+
+def main(count=100000):
+	rolls = links(count, count / 10)
+	urls = list(utils.flatten(rolls))
+	print "%d links, %d distinct" % (len(urls), len(set(urls)))
+	timed('canonical_url, before', count,
+	 lambda: [old_canonical_url(url) for url in urls])
+	utils.url_cache.clear()
+	timed('canonical_url, cold memo', count,
+	 lambda: [utils.canonical_url(url) for url in urls])
+	timed('canonical_url, warm memo', count,
+	 lambda: [utils.canonical_url(url) for url in urls])
+	utils.url_cache.clear()
+	timed('canonical_urls, cold memo', count, utils.canonical_urls, urls)
+	timed('canonical_urls, warm memo', count, utils.canonical_urls, urls)
+	assert utils.canonical_urls(urls) == [old_canonical_url(url) for url in urls]
+	# The old flatten recurses once per item, so only rolls fit
+	limit = sys.getrecursionlimit()
+	sys.setrecursionlimit(max(limit, 2 * count + 100))
+	try:
+		timed('flatten, before (one roll each)', count,
+		 lambda: [old_flatten(roll) for roll in rolls])
+	finally:
+		sys.setrecursionlimit(limit)
+	timed('flatten', count, lambda: list(utils.flatten(rolls)))
+	timed('uniq, before', count, lambda: list(set(urls)))
+	timed('uniq', count, utils.uniq, urls)
+
+if __name__ == '__main__':
+	main(len(sys.argv) > 1 and int(sys.argv[1]) or 100000)
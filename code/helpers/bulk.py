@@ -0,0 +1,64 @@
+"""
+bulk.py
+
+Set based writes that the ORM can't express, such as giving each row its
+own value in a single UPDATE, or inserting many rows at once. Rows are
+sent in chunks, so that a statement never grows without bound. None of
+these commit; run them inside a transaction.
+"""
+from django.db import connection, transaction
+
+# Number of rows per statement
+CHUNK = 1000
+
+def chunks(rows, size=CHUNK):
+	"""Splits a list in to lists of at most size elements."""
+	for i in range(0, len(rows), size):
+		yield rows[i:i+size]
+
+def update_column(model, column, values, chunk=CHUNK):
+	"""Sets column to a separate value for each row of model, where values
+	is a list of (id, value) pairs. Only that column is sent, as one
+	UPDATE ... CASE statement per chunk of rows."""
+	qn = connection.ops.quote_name
+	table, pk = qn(model._meta.db_table), qn(model._meta.pk.column)
+	cursor = connection.cursor()
+	for rows in chunks(values, chunk):
+		sql = "UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % \
+		 (table, qn(column), pk, ' '.join(['WHEN %s THEN %s'] * len(rows)),
+		 pk, ', '.join(['%s'] * len(rows)))
+		params = []
+		for id, value in rows: params.extend([id, value])
+		params.extend([id for id, value in rows])
+		cursor.execute(sql, params)
+	transaction.set_dirty()
+	return len(values)
+
+def insert_rows(model, columns, rows, chunk=CHUNK):
+	"""Inserts rows of model, where rows is a list of tuples of values
+	for columns, as one multi-row INSERT per chunk. Skips the ORM, so
+	the ids of the new rows aren't known."""
+	qn = connection.ops.quote_name
+	cursor = connection.cursor()
+	values = '(%s)' % ', '.join(['%s'] * len(columns))
+	for part in chunks(rows, chunk):
+		sql = "INSERT INTO %s (%s) VALUES %s" % (qn(model._meta.db_table),
+		 ', '.join([qn(column) for column in columns]),
+		 ', '.join([values] * len(part)))
+		params = []
+		for row in part: params.extend(row)
+		cursor.execute(sql, params)
+	transaction.set_dirty()
+	return len(rows)
+
+def delete_rows(model, ids, chunk=CHUNK):
+	"""Deletes the rows of model with the given ids. Skips the ORM, so
+	nothing that refers to them is deleted along with them."""
+	qn = connection.ops.quote_name
+	table, pk = qn(model._meta.db_table), qn(model._meta.pk.column)
+	cursor = connection.cursor()
+	for part in chunks(ids, chunk):
+		cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % \
+		 (table, pk, ', '.join(['%s'] * len(part))), part)
+	transaction.set_dirty()
+	return len(ids)
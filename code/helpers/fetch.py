@@ -0,0 +1,333 @@
+"""
+fetch.py
+
+The HTTP fetch layer shared by the spider, the feed updater and the
+similar artists lookup. Connections are kept alive and pooled per host,
+every request has its own timeout instead of a process wide socket
+default, and only a few requests run against any one host at a time. Besides the blocking fetch, there's fetch_async, which returns
+a pending result right away, and fetch_many for a batch of URLs.
+"""
+import httplib
+import socket
+import threading
+import unittest
+import Queue
+from urlparse import urlparse, urljoin
+
+from zoid.helpers.pool import imap_unordered, HostLimiter
+
+##############################################################################
+class FetchError(IOError):
+	"""Is raised when a URL can't be fetched at all, i.e. we never got a
+	usable response. HTTP error statuses are not exceptions, they're
+	returned as responses."""
+	def __init__(self, str):
+		IOError.__init__(self, str)
+		self.str = str
+	def __str__(self):
+		return self.str
+
+class RedirectError(FetchError):
+	"""Is raised for redirects we can't follow."""
+	pass
+
+##############################################################################
+class Response(object):
+	"""A fetched page. url is the URL we ended up at after redirects,
+	and permanent is True if we got there through permanent redirects
+	only. Header names are lower case."""
+	def __init__(self, status, url, headers, body, permanent=False):
+		self.status = status
+		self.url = url
+		self.headers = headers
+		self.body = body
+		self.permanent = permanent
+
+	def __repr__(self):
+		return '<Response %d %s>' % (self.status, self.url)
+
+##############################################################################
+class Pending(object):
+	"""The result of a fetch that's still running."""
+	def __init__(self):
+		self.event = threading.Event()
+		self.response = self.error = None
+
+	def done(self):
+		return self.event.isSet()
+
+	def result(self, timeout=None):
+		"""Waits for the fetch and returns its response, or raises what
+		the fetch raised."""
+		self.event.wait(timeout)
+		if not self.event.isSet(): raise FetchError("Fetch still running")
+		if self.error: raise self.error
+		return self.response
+
+##############################################################################
+class Fetcher(object):
+	"""Fetches URLs over pooled keep-alive connections."""
+
+	# Seconds we wait for a connection or for data
+	TIMEOUT = 10
+	MAX_REDIRECTS = 5
+	# Idle connections we keep per host
+	MAX_IDLE = 4
+	# Threads running fetch_async and fetch_many
+	WORKERS = 8
+	# Requests in flight to one host, from all threads
+	PER_HOST = 2
+	USER_AGENT = 'Gossip/1.0'
+
+	def __init__(self, timeout=TIMEOUT, workers=WORKERS, per_host=PER_HOST):
+		self.timeout = timeout
+		self.workers = workers
+		self.limiter = HostLimiter(per_host)
+		self.lock = threading.Lock()
+		self.idle = {}
+		self.tasks = None
+
+	def fetch(self, url, headers=None, timeout=None):
+		"""Fetches a URL, following redirects. Returns a Response, or
+		raises FetchError if there's no response to be had."""
+		permanent = None
+		for i in range(self.MAX_REDIRECTS + 1):
+			response = self.request(url, headers, timeout)
+			if response.status not in (301, 302, 303, 307):
+				response.permanent = bool(permanent)
+				return response
+			if not response.headers.has_key('location'):
+				raise RedirectError("Bad redirect from " + url)
+			permanent = (permanent is None or permanent) and response.status == 301
+			url = urljoin(url, response.headers['location'])
+		raise RedirectError("Too many redirects (" + url + ")")
+
+	def fetch_async(self, url, headers=None, timeout=None):
+		"""Starts fetching a URL in the background. Returns a Pending,
+		whose result() is what fetch would have returned."""
+		self.__start()
+		pending = Pending()
+		self.tasks.put((pending, url, headers, timeout))
+		return pending
+
+	def fetch_many(self, urls, headers=None, timeout=None):
+		"""Fetches a batch of URLs concurrently. Returns a list of
+		(url, response, exception) in the order of urls, where one of
+		response and exception is None."""
+		results = {}
+		for url, response, error in imap_unordered( \
+		 lambda url: self.fetch(url, headers, timeout), urls, self.workers):
+			results[url] = (url, response, error)
+		return [results[url] for url in urls]
+
+	def request(self, url, headers=None, timeout=None):
+		"""Does a single GET request, without following redirects. A
+		pooled connection that turns out to be closed is retried once
+		on a new connection. Waits while PER_HOST requests to the host
+		are in flight."""
+		scheme, netloc, path, params, query, fragment = urlparse(url)
+		if scheme not in ('http', 'https') or not netloc:
+			raise FetchError("Can't fetch " + url)
+		if params: path = '%s;%s' % (path, params)
+		if query: path = '%s?%s' % (path, query)
+		send = {'Host': netloc, 'User-Agent': self.USER_AGENT, \
+		 'Accept-Encoding': 'identity'}
+		if headers: send.update(headers)
+		key = (scheme, netloc.lower())
+		if timeout is None: timeout = self.timeout
+		self.limiter.acquire(url)
+		try: return self.__request(url, key, path, send, timeout)
+		finally: self.limiter.release(url)
+
+	def __request(self, url, key, path, send, timeout):
+		for fresh in (False, True):
+			conn, reused = self.__connection(key, timeout, fresh)
+			try:
+				conn.request('GET', path or '/', None, send)
+				response = conn.getresponse()
+				body = response.read()
+			except (httplib.HTTPException, socket.error), inst:
+				conn.close()
+				if reused and not isinstance(inst, socket.timeout): continue
+				raise FetchError("URL %s not found (%s)" % (url, inst))
+			if response.will_close: conn.close()
+			else: self.__release(key, conn)
+			return Response(response.status, url, \
+			 dict([(k.lower(), v) for k, v in response.getheaders()]), body)
+		raise FetchError("URL %s not found (no usable connection)" % url)
+
+	def close(self):
+		"""Closes all idle connections."""
+		self.lock.acquire()
+		try:
+			for conns in self.idle.values():
+				for conn in conns: conn.close()
+			self.idle = {}
+		finally:
+			self.lock.release()
+
+	def __connection(self, key, timeout, fresh=False):
+		"""Returns an idle connection to the host, or a new one if there
+		is none or fresh is set, and whether it was reused."""
+		conn = None
+		if not fresh:
+			self.lock.acquire()
+			try:
+				conns = self.idle.get(key)
+				if conns: conn = conns.pop()
+			finally:
+				self.lock.release()
+		if conn and conn.sock:
+			try:
+				conn.sock.settimeout(timeout)
+				return (conn, True)
+			except socket.error:
+				conn.close()
+		if key[0] == 'https':
+			return (httplib.HTTPSConnection(key[1], timeout=timeout), False)
+		return (httplib.HTTPConnection(key[1], timeout=timeout), False)
+
+	def __release(self, key, conn):
+		self.lock.acquire()
+		try:
+			conns = self.idle.setdefault(key, [])
+			if len(conns) < self.MAX_IDLE: conns.append(conn)
+			else: conn.close()
+		finally:
+			self.lock.release()
+
+	def __start(self):
+		"""Starts the threads behind fetch_async."""
+		self.lock.acquire()
+		try:
+			if self.tasks: return
+			self.tasks = Queue.Queue()
+			for i in range(self.workers):
+				thread = threading.Thread(target=self.__work)
+				thread.setDaemon(True)
+				thread.start()
+		finally:
+			self.lock.release()
+
+	def __work(self):
+		while True:
+			pending, url, headers, timeout = self.tasks.get()
+			try: pending.response = self.fetch(url, headers, timeout)
+			except Exception, inst: pending.error = inst
+			pending.event.set()
+
+# The fetcher everybody shares
+fetcher = Fetcher()
+
+# ========================================================================
+import time
+import BaseHTTPServer
+import SocketServer
+
+class tst_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""A stand-in web server for the tests."""
+	protocol_version = 'HTTP/1.1'
+	connections = set()
+
+	def do_GET(self):
+		self.connections.add(self.client_address)
+		routes = {'/ok': (200, None), '/moved': (301, '/found'), '/gone': (301, '/ok'),
+		 '/found': (302, '/ok'), '/bad': (302, None), '/loop': (302, '/loop')}
+		if self.path == '/slow': time.sleep(1)
+		status, location = routes.get(self.path, (404, None))
+		body = 'page %s' % self.path
+		self.send_response(status)
+		if location: self.send_header('Location', location)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+class tst_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	def handle_error(self, request, client_address):
+		# The client gave up on /slow
+		pass
+
+class test_fetch(unittest.TestCase):
+	'''Tests for the fetcher, against a local web server.'''
+
+	def setUp(self):
+		self.server = tst_server(('127.0.0.1', 0), tst_handler)
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.setDaemon(True)
+		thread.start()
+		self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+		self.fetcher = Fetcher(timeout=0.5)
+		tst_handler.connections = set()
+
+	def tearDown(self):
+		self.fetcher.close()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_fetch(self):
+		response = self.fetcher.fetch(self.base + '/ok')
+		self.assertEqual(response.status, 200)
+		self.assertEqual(response.body, 'page /ok')
+		self.assertEqual(response.headers['content-length'], '8')
+		self.assertEqual(self.fetcher.fetch(self.base + '/nothing').status, 404)
+
+	def test_per_host(self):
+		fetcher = Fetcher(timeout=5, per_host=1)
+		start = time.time()
+		results = fetcher.fetch_many([self.base + '/slow'] * 2)
+		self.assert_(time.time() - start >= 2)
+		self.assertEqual([r[1].status for r in results], [404, 404])
+		fetcher.close()
+
+	def test_keep_alive(self):
+		for i in range(5): self.fetcher.fetch(self.base + '/ok')
+		self.assertEqual(len(tst_handler.connections), 1)
+
+	def test_redirects(self):
+		response = self.fetcher.fetch(self.base + '/moved')
+		self.assertEqual((response.status, response.url, response.permanent),
+		 (200, self.base + '/ok', False))
+		response = self.fetcher.fetch(self.base + '/gone')
+		self.assertEqual((response.url, response.permanent), (self.base + '/ok', True))
+		self.assertRaises(RedirectError, self.fetcher.fetch, self.base + '/bad')
+		self.assertRaises(RedirectError, self.fetcher.fetch, self.base + '/loop')
+
+	def test_stale_connections(self):
+		# Two pooled connections that the other end has closed
+		dead = socket.socket()
+		dead.bind(('127.0.0.1', 0))
+		dead.listen(2)
+		key = ('http', '127.0.0.1:%d' % self.server.server_address[1])
+		for i in range(2):
+			conn = httplib.HTTPConnection(*dead.getsockname())
+			conn.connect()
+			dead.accept()[0].close()
+			self.fetcher.idle.setdefault(key, []).append(conn)
+		dead.close()
+		self.assertEqual(self.fetcher.fetch(self.base + '/ok').body, 'page /ok')
+
+	def test_timeout(self):
+		self.assertRaises(FetchError, self.fetcher.fetch, self.base + '/slow')
+
+	def test_async(self):
+		pending = self.fetcher.fetch_async(self.base + '/ok')
+		self.assertEqual(pending.result(5).body, 'page /ok')
+		pending = self.fetcher.fetch_async('ftp://example.com/')
+		self.assertRaises(FetchError, pending.result, 5)
+
+	def test_fetch_many(self):
+		urls = [self.base + p for p in ['/ok', '/found', '/slow', '/nothing']]
+		results = self.fetcher.fetch_many(urls)
+		self.assertEqual([r[0] for r in results], urls)
+		self.assertEqual(results[0][1].status, 200)
+		self.assertEqual(results[1][1].url, self.base + '/ok')
+		self.assert_(isinstance(results[2][2], FetchError))
+		self.assertEqual(results[3][1].status, 404)
+
+
+if __name__ == '__main__':
+	unittest.main()
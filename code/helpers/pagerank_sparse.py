@@ -0,0 +1,375 @@
+"""
+pagerank_sparse.py
+Page rank over a link graph kept in compressed sparse row form.
+
+The link graph is stored as a CSR matrix with one row per source node,
+so the index array is all we keep per link. Every link has the value 1;
+instead of weighting links by 1/outdegree of their source, the vector is
+scaled by it before each product. The damping factor and the
+rank of dangling nodes (nodes without outgoing links) are never put in
+the matrix; they are rank-one corrections added to the vector in each
+step of the power method. Memory is O(N + E) instead of O(N^2).
+
+When the graph has only grown a little since the last run, the old rank
+vector is a much better start than the uniform one; see warm_start.
+
+Personalized page rank, where the random surfer teleports to a set of
+seed nodes instead of to any node, is solved for many seed sets at once
+by iterating the sparse matrix against a dense block of vectors.
+
+The power method itself, with its stopping rules, is power_method below,
+which is shared with pagerank_url.
+
+A graph can be saved as a snapshot, a single int32 .npy file holding the
+ids and the CSR arrays, which is memory mapped when loaded again. The
+arrays are used as they are in the file, so processes mapping the same
+snapshot share the link structure.
+"""
+
+import os
+import tempfile
+import unittest
+from math import ceil, log
+from numpy import ones, asarray, unique, searchsorted, arange, \
+ zeros, maximum, sqrt, concatenate, broadcast_to, newaxis, iinfo, setdiff1d, \
+ int32, int64, float64, abs
+from numpy import save as save_array, load as load_array, may_share_memory
+from scipy import sparse
+
+# Default stopping rules for the power method
+TOLERANCE = 1.0e-8
+NORM = 'l1'
+MAX_ITERATIONS = 200
+
+# Norms we can measure the residual in. Work column by column, so that
+# a block of vectors has converged when its worst column has.
+NORMS = {
+	'l1': lambda D: abs(D).sum(axis=0).max(),
+	'l2': lambda D: sqrt((D * D).sum(axis=0)).max(),
+	'max': lambda D: abs(D).max(),
+}
+
+def power_method(step, V, tolerance=TOLERANCE, norm=NORM, \
+ max_iterations=MAX_ITERATIONS):
+	"""Iterates V = step(V) until the residual, the norm of the change
+	in V, is below tolerance, or max_iterations is reached. V is kept
+	normalized to L1 norm 1 (per column). Returns V and a dict of stats:
+	the number of iterations, the residual of each iteration and whether
+	we converged."""
+	if not NORMS.has_key(norm):
+		raise ValueError("Unknown norm %s" % norm)
+	residual_of = NORMS[norm]
+	V = V / abs(V).sum(axis=0)
+	residuals = []
+	converged = False
+	while len(residuals) < max_iterations:
+		Vn = step(V)
+		Vn = Vn / abs(Vn).sum(axis=0)
+		residuals.append(float(residual_of(Vn - V)))
+		V = Vn
+		if residuals[-1] < tolerance:
+			converged = True
+			break
+	return (V, {'iterations': len(residuals), 'residuals': residuals,
+	 'converged': converged, 'tolerance': tolerance, 'norm': norm})
+
+class SparseRank(object):
+	"""Calculates the page rank of a link graph given as CSR arrays,
+	i.e. the outgoing links of node i are indices[indptr[i]:indptr[i+1]],
+	and ids[i] is the external id (eg. the blog id) of node i."""
+
+	# 1 - The damping factor of the graph
+	DAMP = 0.85
+
+	def __init__(self, ids, indptr, indices, damp=DAMP):
+		self.ids = asarray(ids)
+		self.size = len(self.ids)
+		self.damp = damp
+		self.indptr = asarray(indptr)
+		self.indices = asarray(indices)
+		outdegree = self.indptr[1:] - self.indptr[:-1]
+		self.dangling = (outdegree == 0)
+		# Each link carries 1/outdegree of its source, which is what
+		# spread scales the vector by. The links themselves are all 1,
+		# a single value repeated without being stored per link. The
+		# transpose of a CSR matrix is a CSC matrix sharing the same
+		# arrays, so the mat-vec below never copies the link structure.
+		self.share = 1.0 / maximum(outdegree, 1)
+		self.links = sparse.csr_matrix((broadcast_to(float64(1.0), \
+		 self.indices.shape), self.indices, self.indptr),
+		 shape=(self.size, self.size))
+		self.matrix = self.links.transpose()
+		self.iterations = 0
+		self.stats = None
+
+	def from_links(cls, ids, sources, destinations, damp=DAMP):
+		"""Builds the graph from a list of node ids and two parallel
+		lists of link endpoints, given as ids. Links to or from ids we
+		don't know of are dropped, as are duplicate links."""
+		ids = unique(asarray(ids, dtype=int64))
+		src = cls.positions(ids, sources)
+		dst = cls.positions(ids, destinations)
+		known = (src >= 0) & (dst >= 0)
+		src, dst = src[known], dst[known]
+		links = sparse.csr_matrix((ones(len(src)), (src, dst)),
+		 shape=(len(ids), len(ids)))
+		# Duplicates were summed when converting to CSR
+		links.sum_duplicates()
+		return cls(ids, links.indptr, links.indices.astype(int32), damp)
+	from_links = classmethod(from_links)
+
+	def save(self, path):
+		"""Writes the graph to a snapshot file: the number of nodes and
+		links, followed by the ids, indptr and indices arrays, all as
+		one int32 array, which is what scipy indexes with. The file is
+		written under a temporary name and renamed, so readers never
+		see half a snapshot."""
+		largest = max(list(self.ids[-1:]) + [len(self.indices)])
+		if largest > iinfo(int32).max:
+			raise ValueError("Graph too large for a snapshot (%d)" % largest)
+		header = asarray([self.size, len(self.indices)], dtype=int32)
+		tmp = '%s.%d.tmp' % (path, os.getpid())
+		f = open(tmp, 'wb')
+		try: save_array(f, concatenate([header, self.ids.astype(int32), \
+		 self.indptr.astype(int32), self.indices.astype(int32)]))
+		finally: f.close()
+		os.rename(tmp, path)
+
+	def load(cls, path, damp=DAMP):
+		"""Memory maps a snapshot written by save."""
+		data = load_array(path, mmap_mode='r')
+		N, E = int(data[0]), int(data[1])
+		return cls(data[2:2+N], data[2+N:3+2*N], data[3+2*N:3+2*N+E], damp)
+	load = classmethod(load)
+
+	def positions(ids, values):
+		"""Maps external ids to positions in the sorted array ids.
+		Unknown ids are mapped to -1."""
+		values = asarray(values, dtype=int64)
+		if not len(ids): return zeros(len(values), dtype=int64) - 1
+		pos = searchsorted(ids, values)
+		pos[pos == len(ids)] = 0
+		pos[ids[pos] != values] = -1
+		return pos
+	positions = staticmethod(positions)
+
+	def get_rank(self):
+		"""Calculates the pagerank. Returns the ids and the rank vector,
+		which sums to one."""
+		return (self.ids, self.find_dominant())
+
+	def warm_start(self, ids, ranks):
+		"""Builds a start vector from the ranks of an earlier run, given
+		as parallel lists of ids and ranks. Nodes we have no earlier rank
+		for are padded with the rank of a node without any inbound links,
+		(1 - damp)/n. Returns the vector and a mask of the new nodes."""
+		ranks = asarray(ranks, dtype=float64)
+		pos = self.positions(self.ids, ids)
+		known = (pos >= 0) & (ranks > 0)
+		V = zeros(self.size)
+		if known.any():
+			V[pos[known]] = ranks[known] / ranks[known].sum()
+		new = (V == 0)
+		V[new] = (1.0 - self.damp) / self.size
+		return (V / V.sum(), new)
+
+	def links_touching(self, mask):
+		"""Counts the links from or to any of the nodes in mask."""
+		sources = arange(self.size).repeat(self.indptr[1:] - self.indptr[:-1])
+		return int((mask[sources] | mask[self.indices]).sum())
+
+	def link_keys(self):
+		"""The links as one sorted int64 per link, with the id of the
+		source in the high and the id of the destination in the low
+		32 bits."""
+		ids = self.ids.astype(int64)
+		sources = ids.repeat(self.indptr[1:] - self.indptr[:-1])
+		return (sources << 32) | ids[self.indices]
+
+	def link_changes(self, earlier):
+		"""The number of links added and removed since earlier, a graph
+		of the same kind of ids."""
+		now, then = self.link_keys(), earlier.link_keys()
+		return (len(setdiff1d(now, then, True)), len(setdiff1d(then, now, True)))
+
+	def cold_iterations(self, tolerance=TOLERANCE):
+		"""Estimates the number of iterations needed from the uniform
+		start vector. The error shrinks by at least a factor damp in
+		each iteration, and is at most 2 to begin with."""
+		return int(ceil(log(tolerance / 2.0) / log(self.damp)))
+
+	def teleport(self, seed_sets):
+		"""Builds a (n, k) block of teleport distributions from k seed sets,
+		each a pair of lists of ids and weights. Ids we don't know of are
+		dropped. Returns the block and a mask of the seed sets that had
+		any known ids; the columns of the others are all zero."""
+		P = zeros((self.size, len(seed_sets)))
+		for j, (ids, weights) in enumerate(seed_sets):
+			pos = self.positions(self.ids, ids)
+			weights = asarray(weights, dtype=float64)
+			known = (pos >= 0) & (weights > 0)
+			P[pos[known], j] += weights[known]
+		total = P.sum(axis=0)
+		P[:, total > 0] /= total[total > 0]
+		return (P, total > 0)
+
+	def personalized(self, P, tolerance=TOLERANCE, norm=NORM, \
+	 max_iterations=MAX_ITERATIONS):
+		"""Finds the personalized page rank for each column of P, a block
+		of teleport distributions (see teleport). All columns are solved
+		in the same iterations, as one sparse matrix times dense block
+		product per step. The stats are kept in self.stats."""
+		def step(V):
+			Vn = self.damp * (self.matrix * self.spread(V))
+			Vn += P * (self.damp * V[self.dangling].sum(axis=0) + \
+			 (1.0 - self.damp) * V.sum(axis=0))
+			return Vn
+		V, self.stats = power_method(step, P.copy(), tolerance, norm, \
+		 max_iterations)
+		self.iterations = self.stats['iterations']
+		return V
+
+	def find_dominant(self, V=None, tolerance=TOLERANCE, norm=NORM, \
+	 max_iterations=MAX_ITERATIONS):
+		"""Finds the dominant eigenvector of the google matrix using the
+		power method, starting from V or (1/n, ..., 1/n)'. The stats
+		of the run are kept in self.stats, see power_method."""
+		if V is None: V = ones(self.size) / self.size
+		V, self.stats = power_method(self.iterate_once, V, tolerance, \
+		 norm, max_iterations)
+		self.iterations = self.stats['iterations']
+		return V
+
+	def iterate_once(self, V):
+		"""Performs one iteration in the power method. The teleport term
+		and the dangling nodes spread their rank evenly over all nodes,
+		which is the same constant added to every element."""
+		Vn = self.damp * (self.matrix * self.spread(V))
+		Vn += (self.damp * V[self.dangling].sum() + \
+		 (1.0 - self.damp) * V.sum()) / self.size
+		return Vn
+
+	def spread(self, V):
+		"""The rank each node passes along each of its links, for a
+		vector or a block of vectors."""
+		if V.ndim == 1: return V * self.share
+		return V * self.share[:, newaxis]
+
+# ========================================================================
+def tst_make_graph():
+	"""The same fictious web as in pagerank_url, with ids 10-60
+	instead of URLs, and one link to a node we don't know of."""
+	google, goagrejor, idg, scipy, enea, apple = (10, 20, 30, 40, 50, 60)
+	links = [(goagrejor, google), (goagrejor, enea), (goagrejor, apple),
+	 (idg, google), (idg, goagrejor), (idg, enea), (idg, scipy),
+	 (google, enea), (google, google), (google, goagrejor), (google, idg),
+	 (google, scipy), (scipy, enea), (enea, google), (enea, goagrejor),
+	 (enea, enea), (apple, idg), (apple, idg), (apple, 70)]
+	ids = [google, goagrejor, idg, scipy, enea, apple]
+	return SparseRank.from_links(ids, [l[0] for l in links], \
+	 [l[1] for l in links])
+
+class test_sparse_rank(unittest.TestCase):
+	'''Tests for the sparse page rank.'''
+
+	def setUp(self):
+		self.rank = tst_make_graph()
+
+	def test_from_links(self):
+		self.assertEqual(list(self.rank.ids), [10, 20, 30, 40, 50, 60])
+		# Duplicate and unknown links are dropped
+		self.assertEqual(self.rank.links.nnz, 17)
+		self.assert_(not self.rank.dangling.any())
+
+	def test_dense_equivalent(self):
+		# Compare against the dense google matrix
+		N = self.rank.size
+		A = self.rank.links.multiply(self.rank.share.reshape((N, 1))).todense()
+		G = self.rank.DAMP * A.transpose() + (1.0 - self.rank.DAMP) / N
+		ids, V = self.rank.get_rank()
+		self.assert_(abs(G * V.reshape((N, 1)) - V.reshape((N, 1))).sum() < 1e-6)
+		self.assert_(abs(V.sum() - 1.0) < 1e-9)
+
+	def test_dangling(self):
+		rank = SparseRank.from_links([1, 2, 3], [1, 2], [2, 1])
+		self.assertEqual(list(rank.dangling), [False, False, True])
+		ids, V = rank.get_rank()
+		self.assert_(abs(V.sum() - 1.0) < 1e-9)
+		self.assert_(V[2] < V[0])
+
+	def test_pagerank(self):
+		ids, V = self.rank.get_rank()
+		order = [ids[i] for i in (-V).argsort()]
+		# Ordningen: ENEA, Google, Goagrejor, IDG, SciPy, Apple
+		self.assertEqual(order, [50, 10, 20, 30, 40, 60])
+
+	def test_warm_start(self):
+		ids, V = self.rank.get_rank()
+		cold = self.rank.iterations
+		# Add a new blog, linked from Google, and restart from the old ranks
+		grown = SparseRank.from_links(list(ids) + [70],
+		 [10, 10, 10, 10, 10, 10, 20, 20, 20, 30, 30, 30, 30, 40, 50, 50, 50, 60],
+		 [50, 10, 20, 30, 40, 70, 10, 50, 60, 10, 20, 50, 40, 50, 10, 20, 50, 30])
+		start, new = grown.warm_start(ids, V * len(V))
+		self.assertEqual(list(new), [False] * 6 + [True])
+		self.assertEqual(grown.links_touching(new), 1)
+		self.assertEqual(grown.link_changes(self.rank), (1, 0))
+		# A link replaced by another is one added and one removed
+		before = SparseRank.from_links([1, 2, 3], [1, 2, 1], [2, 3, 3])
+		after = SparseRank.from_links([1, 2, 3], [1, 2, 3], [2, 3, 1])
+		self.assertEqual(after.link_changes(before), (1, 1))
+		W = grown.find_dominant(start)
+		self.assert_(grown.iterations < cold)
+		self.assert_(abs(W - grown.find_dominant()).sum() < 1e-6)
+
+	def test_convergence(self):
+		V = self.rank.find_dominant(tolerance=1e-4, norm='max')
+		stats = self.rank.stats
+		self.assert_(stats['converged'])
+		self.assertEqual(stats['iterations'], len(stats['residuals']))
+		self.assert_(stats['residuals'][-1] < 1e-4)
+		self.assert_(stats['residuals'][-2] >= 1e-4)
+		V = self.rank.find_dominant(max_iterations=3)
+		self.assert_(not self.rank.stats['converged'])
+		self.assertEqual(self.rank.iterations, 3)
+		self.assert_(abs(V.sum() - 1.0) < 1e-9)
+		self.assertRaises(ValueError, self.rank.find_dominant, None, 1e-4, 'l3')
+
+	def test_personalized(self):
+		P, known = self.rank.teleport([([10, 20, 30, 40, 50, 60], [1] * 6),
+		 ([60], [1]), ([20, 30, 70], [3, 1, 5]), ([70], [1])])
+		self.assertEqual(list(known), [True, True, True, False])
+		self.assertEqual(list(P[:, 2]), [0, 0.75, 0.25, 0, 0, 0])
+		V = self.rank.personalized(P[:, known])
+		self.assert_(self.rank.stats['converged'])
+		# Uniform seeds give the global rank
+		self.assert_(abs(V[:, 0] - self.rank.find_dominant()).sum() < 1e-6)
+		# A column in a block is the same as solving it on its own
+		W = self.rank.personalized(P[:, 1:2])
+		self.assert_(abs(V[:, 1] - W[:, 0]).sum() < 1e-6)
+		# Seeding on Apple favours Apple, and IDG which it links to
+		self.assert_(V[5, 1] > 2 * V[5, 0])
+		self.assert_(V[2, 1] > V[2, 0])
+
+	def test_snapshot(self):
+		fd, path = tempfile.mkstemp('.npy')
+		os.close(fd)
+		try:
+			self.rank.save(path)
+			loaded = SparseRank.load(path)
+			self.assertEqual(list(loaded.ids), list(self.rank.ids))
+			self.assertEqual(list(loaded.indptr), list(self.rank.indptr))
+			self.assertEqual(list(loaded.indices), list(self.rank.indices))
+			# scipy uses the mapped arrays, without copying them
+			self.assertEqual(loaded.links.indices.dtype, int32)
+			self.assert_(may_share_memory(loaded.links.indices, loaded.indices))
+			self.assert_(may_share_memory(loaded.links.indptr, loaded.indptr))
+			self.assert_(abs(loaded.find_dominant() - \
+			 self.rank.find_dominant()).sum() < 1e-9)
+			del loaded
+		finally:
+			os.remove(path)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -16,6 +16,8 @@ Ideas:
 import unittest
 from numpy import linalg, ones, dot, array, abs, size, sum, allclose
 from scipy import sparse
+from zoid.helpers.pagerank_sparse import power_method, TOLERANCE, NORM, \
+ MAX_ITERATIONS
 
 class Pagerank:
 	"""Contains methods for building a pagerank graph and
@@ -28,6 +30,7 @@ class Pagerank:
 		self.normal_matrix = None
 		self.links = sparse.lil_matrix((self.dim, self.dim))
 		self.invalid = True
+		self.stats = None
 	
 	def has_indexed(self, url):
 		return self.urls.has_key(url)
@@ -103,29 +106,25 @@ class Pagerank:
 		self.invalid = False
 		return result
 		
-	def find_dominant(self, A):
+	def find_dominant(self, A, tolerance=TOLERANCE, norm=NORM, \
+	 max_iterations=MAX_ITERATIONS):
 		"""Finds the dominant eigenvector of matrix A.
 		Since no method currently exist in SciPack for iteratively 
 		finding	the dominant eigenvector (wich we know exist), we 
-		calculate it by hand using the power method."""
+		calculate it by hand using the power method. The stats of
+		the run are kept in self.stats, see power_method."""
 		# Start by taking a random guess, we choose (1/n, ..., 1/n)'
 		N = A.shape[0]
-		V = sparse.lil_matrix((1,N))
-		V[0,0:N] = ones((1,N)) * 1/N
-		V = V.transpose()
+		V = ones(N) * 1.0/N
 		# Iterate until we get sufficient precision
-		while True:
-			Vn = self.iterate_once(A,V)
-			if allclose(Vn.todense(), V.todense()): break
-			V = Vn
-		return Vn.todense()
+		Vn, self.stats = power_method(lambda V: self.iterate_once(A,V), \
+		 V, tolerance, norm, max_iterations)
+		return Vn
 		
 	def iterate_once(self,A,V):
 		"""Performs one iteration in the power method for approximating
-		an eigenvector."""
-		V =  A * V
-		Vend = float(V[size(V)-1,0])
-		return 1 / Vend * V
+		an eigenvector. Normalization is left to power_method."""
+		return A * V
 
 # ========================================================================
 def tst_make_list():
@@ -0,0 +1,129 @@
+"""
+pool.py
+
+A small pool of worker threads for work that mostly waits on the network,
+such as fetching pages. Results are handed back to the thread that reads
+them, so that everything touching the database can stay on that single
+writer thread.
+"""
+import threading
+import Queue
+import unittest
+from urlparse import urlparse
+
+##############################################################################
+class WorkerPool(object):
+	"""Runs func over the items put in the pool, in a number of worker
+	threads. Items may be put while reading results."""
+
+	# Tells a worker to quit
+	STOP = object()
+
+	def __init__(self, func, workers=8):
+		self.func = func
+		self.tasks = Queue.Queue()
+		self.done = Queue.Queue()
+		self.pending = 0
+		self.threads = [threading.Thread(target=self.__work) \
+		 for i in range(workers)]
+		for thread in self.threads:
+			thread.setDaemon(True)
+			thread.start()
+
+	def put(self, item):
+		"""Queues an item for the workers."""
+		self.pending += 1
+		self.tasks.put(item)
+
+	def results(self):
+		"""Yields (item, result, exception) for each item put, in the order
+		they finish, until no item is pending. Exception is None unless
+		func raised one, in which case result is None."""
+		while self.pending:
+			item, result, error = self.done.get()
+			self.pending -= 1
+			yield (item, result, error)
+
+	def close(self):
+		"""Stops the workers once they're done with what's queued."""
+		for thread in self.threads:
+			self.tasks.put(self.STOP)
+
+	def __work(self):
+		while True:
+			item = self.tasks.get()
+			if item is self.STOP: return
+			try: result = self.func(item)
+			except Exception, inst: self.done.put((item, None, inst))
+			else: self.done.put((item, result, None))
+
+def imap_unordered(func, items, workers=8):
+	"""Yields (item, result, exception) for func over items, see
+	WorkerPool.results."""
+	pool = WorkerPool(func, workers)
+	try:
+		for item in items: pool.put(item)
+		for result in pool.results(): yield result
+	finally:
+		pool.close()
+
+##############################################################################
+class HostLimiter(object):
+	"""Limits the number of requests in flight to each host, so that a
+	pool of workers doesn't hammer a single site."""
+
+	def __init__(self, per_host=2):
+		self.per_host = per_host
+		self.lock = threading.Lock()
+		self.hosts = {}
+
+	def acquire(self, url):
+		self.__semaphore(url).acquire()
+
+	def release(self, url):
+		self.__semaphore(url).release()
+
+	def __semaphore(self, url):
+		host = urlparse(url)[1].lower()
+		self.lock.acquire()
+		try:
+			if not self.hosts.has_key(host):
+				self.hosts[host] = threading.Semaphore(self.per_host)
+			return self.hosts[host]
+		finally:
+			self.lock.release()
+
+# ========================================================================
+class test_pool(unittest.TestCase):
+	'''Tests for the worker pool.'''
+
+	def test_results(self):
+		results = list(imap_unordered(lambda x: 10 / x, [1, 2, 0, 5], 3))
+		self.assertEqual(sorted([(r[0], r[1]) for r in results]),
+		 [(0, None), (1, 10), (2, 5), (5, 2)])
+		errors = [r[2] for r in results if r[2]]
+		self.assertEqual(len(errors), 1)
+		self.assert_(isinstance(errors[0], ZeroDivisionError))
+
+	def test_put_while_reading(self):
+		pool = WorkerPool(lambda x: x - 1, 2)
+		pool.put(3)
+		seen = []
+		for item, result, error in pool.results():
+			seen.append(item)
+			if result > 0: pool.put(result)
+		pool.close()
+		self.assertEqual(seen, [3, 2, 1])
+
+	def test_host_limit(self):
+		limiter = HostLimiter(1)
+		limiter.acquire('http://a.com/1')
+		# Another host is not blocked
+		limiter.acquire('http://b.com/')
+		self.assert_(not limiter._HostLimiter__semaphore('http://A.com/2').acquire(False))
+		limiter.release('http://a.com/1')
+		self.assert_(limiter._HostLimiter__semaphore('http://a.com/2').acquire(False))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,67 @@
+"""
+urlclass.py
+
+Classifies URLs against a set of rules, such as the music providers of a
+feed or the sites a blog roll shouldn't point to. The rules are regular
+expressions matched from the start of the URL. Instead of trying them one
+by one, they're compiled in to a single alternation, once per process, so
+a URL is classified in one pass. Hits are counted per rule.
+"""
+import re
+import unittest
+
+class UrlClassifier(object):
+	"""Matches URLs against a list of regular expression rules at once.
+	A rule is identified by its pattern."""
+
+	def __init__(self, rules, flags=re.IGNORECASE):
+		self.rules = list(rules)
+		self.regex = re.compile('|'.join(['(?P<r%d>%s)' % (i, rule) \
+		 for i, rule in enumerate(self.rules)]), flags)
+		self.hits = dict([(rule, 0) for rule in self.rules])
+
+	def match(self, url):
+		"""Returns the first rule that matches url, or None."""
+		match = self.regex.match(url)
+		if not match: return None
+		# The named group around each rule is the last one to close
+		rule = self.rules[int(match.lastgroup[1:])]
+		self.hits[rule] += 1
+		return rule
+
+	def __contains__(self, url):
+		return self.match(url) is not None
+
+# ========================================================================
+class test_urlclass(unittest.TestCase):
+	'''Tests for the URL classifier.'''
+
+	def setUp(self):
+		self.rules = UrlClassifier(['http://(www\.)?last.fm.*',
+		 '.*wikipedia.org.*', 'http://(.+)?\.amazon\.', '.*?\.mp3$'])
+
+	def test_match(self):
+		self.assertEqual(self.rules.match('http://www.last.fm/music'),
+		 'http://(www\.)?last.fm.*')
+		self.assertEqual(self.rules.match('http://en.Wikipedia.org/x'),
+		 '.*wikipedia.org.*')
+		self.assertEqual(self.rules.match('http://www.amazon.com/'),
+		 'http://(.+)?\.amazon\.')
+		self.assertEqual(self.rules.match('http://a.com/b.MP3'), '.*?\.mp3$')
+		self.assertEqual(self.rules.match('http://a.com/b.mp3x'), None)
+		self.assert_('http://example.com/' not in self.rules)
+
+	def test_first_rule_wins(self):
+		rules = UrlClassifier(['.*\.com', 'http://a\.com'])
+		self.assertEqual(rules.match('http://a.com'), '.*\.com')
+
+	def test_hits(self):
+		for url in ['http://last.fm', 'http://last.fm/x', 'http://a.com/c.mp3']:
+			self.rules.match(url)
+		self.assertEqual(self.rules.hits['http://(www\.)?last.fm.*'], 2)
+		self.assertEqual(self.rules.hits['.*?\.mp3$'], 1)
+		self.assertEqual(self.rules.hits['.*wikipedia.org.*'], 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -4,17 +4,13 @@ utils.py
 Small helper utilities and such.
 """
 import re
-import urllib2
-import socket
+import zlib
+import base64
+import threading
+import unittest
+from urlparse import urlparse
 
-##############################################################################
-class RedirectHandler(urllib2.HTTPDefaultErrorHandler):  
-	"""Catches exceptions from urllib2 and converts them to ordinary
-	requests."""  
-	def http_error_default(self, req, fp, code, msg, headers):
-		result = urllib2.HTTPError(req.get_full_url(), code, msg, headers, fp)       
-		result.status = code
-		return result
+from zoid.helpers.fetch import fetcher, FetchError, RedirectError
 
 ##############################################################################
 class IllegalBlogException(Exception):
@@ -26,69 +22,271 @@ class IllegalBlogException(Exception):
 	def __str__(self):
 		return self.str
 
+##############################################################################
+class LRUCache(object):
+	"""A dict like cache that holds at most size entries, dropping the
+	least recently used one when it's full. Not thread safe."""
+
+	def __init__(self, size):
+		self.size = size
+		self.links = {}
+		# A circular list of [previous, next, key, value], most recently
+		# used first
+		self.root = []
+		self.root[:] = [self.root, self.root, None, None]
+
+	def __len__(self):
+		return len(self.links)
+
+	def __contains__(self, key):
+		return key in self.links
+
+	def __getitem__(self, key):
+		link = self.links[key]
+		self.__unlink(link)
+		self.__push(link)
+		return link[3]
+
+	def get(self, key, default=None):
+		if key not in self.links: return default
+		return self[key]
+
+	def __setitem__(self, key, value):
+		link = self.links.get(key)
+		if link:
+			self.__unlink(link)
+			link[3] = value
+		else:
+			link = self.links[key] = [None, None, key, value]
+			if len(self.links) > self.size:
+				oldest = self.root[0]
+				self.__unlink(oldest)
+				del self.links[oldest[2]]
+		self.__push(link)
+
+	def pop(self, key, default=None):
+		link = self.links.pop(key, None)
+		if not link: return default
+		self.__unlink(link)
+		return link[3]
+
+	def clear(self):
+		self.links = {}
+		self.root[:] = [self.root, self.root, None, None]
+
+	def __unlink(self, link):
+		link[0][1], link[1][0] = link[1], link[0]
+
+	def __push(self, link):
+		link[0], link[1] = self.root, self.root[1]
+		self.root[1][0] = link
+		self.root[1] = link
+
 ##############################################################################
 def get_data_from_url(url):
 	"""Returns data and actual URL for the web site presumably
 	located at URL."""
-	# timeout in seconds. We need one of these to get the 
-	# speed of the process up.
-	socket.setdefaulttimeout(10)
-
-	# Handle 3xx redirects of a page, and other error
-	# events that might occurs
-	opener = urllib2.build_opener(RedirectHandler)
-	while True:			
-		request = urllib2.Request(url)
-		try: response = opener.open(request)
+	# Redirects are followed by the fetcher. If the site can't
+	# be reached at all, we give it another try with a www.
+	while True:
+		try: response = fetcher.fetch(url)
+		except RedirectError, inst:
+			raise IllegalBlogException(str(inst))
 		# URL not found, bogus URL
-		except urllib2.URLError: 
+		except FetchError, inst:
 			if canonical_url(url) == url:
 				url = www_url(url)
-				if not url: 
-					raise IllegalBlogException("URL "+url+" not found")
 			else: raise IllegalBlogException("URL "+url+" not found")
-		# Other unhandled error
-		#except: raise IllegalBlogException("Unknown error ("+url+")")
 		else:
 			# Things went ok
-			if not vars(response).has_key('status') or response.status == 200: 
-				break
-			# We've redirected, so let's give it another try
-			if response.status in [301,302]:
-				if not response.headers.has_key('Location'):
-					raise IllegalBlogException("Bad redirect from "+ url)
-				# Another unhandled error
-				else: 
-					raise IllegalBlogException(page, "Unknown error("+url+")")
+			if response.status == 200: break
+			raise IllegalBlogException("Unknown error (%d, %s)" % \
+			 (response.status, url))
 	# Return the data and the URL
-	return (response.read(), canonical_url(response.geturl()))
+	return (response.body, canonical_url(response.url))
+
+# The patterns of canonical_url, compiled once
+INDEX_PAGE = re.compile("(.+?)/index.htm(l)?")
+BARE_HOST = re.compile("^(http://([^/]+)?)(/$|$)")
+WWW_HOST = re.compile("^http://www\.(.+)")
+
+# Number of URLs canonical_url remembers. The memo is shared by the
+# fetch threads, hence the lock.
+URL_CACHE_SIZE = 50000
+url_cache = LRUCache(URL_CACHE_SIZE)
+url_lock = threading.Lock()
 
 def canonical_url(url):
 	"""Returns a canonical representation of a URL,
 	i.e. dropping any tailing slashes and removing any WWW"""
-	match = re.match("(.+?)/index.htm(l)?", url)
+	url_lock.acquire()
+	try: canonical = url_cache.get(url)
+	finally: url_lock.release()
+	if canonical is None:
+		canonical = normalize_url(url)
+		url_lock.acquire()
+		try: url_cache[url] = canonical
+		finally: url_lock.release()
+	return canonical
+
+def canonical_urls(urls):
+	"""canonical_url for a list of URLs, taking the lock twice at most."""
+	canonical = []
+	# The positions of each URL we don't know yet
+	missing = {}
+	url_lock.acquire()
+	try:
+		for url in urls:
+			known = url_cache.get(url)
+			if known is None: missing.setdefault(url, []).append(len(canonical))
+			canonical.append(known)
+	finally: url_lock.release()
+	if missing:
+		fresh = [(url, normalize_url(url)) for url in missing]
+		url_lock.acquire()
+		try:
+			for url, normal in fresh: url_cache[url] = normal
+		finally: url_lock.release()
+		for url, normal in fresh:
+			for i in missing[url]: canonical[i] = normal
+	return canonical
+
+def normalize_url(url):
+	"""canonical_url without the memo."""
+	match = INDEX_PAGE.match(url)
 	if match: url = match.group(1)
-	match = re.match("^(http://([^/]+)?)(/$|$)", url)
+	match = BARE_HOST.match(url)
 	if match: url = match.group(1)
-	match = re.match("^http://www\.(.+)", url)
+	match = WWW_HOST.match(url)
 	if match: url = 'http://' + match.group(1)
 	return url
 
 def www_url(url):
 	url = canonical_url(url)
-	match = re.match("^http://(.+)", url)
-	if match:
-		url = 'http://www.' + match.group(1)
+	if url.startswith('http://') and len(url) > 7:
+		url = 'http://www.' + url[7:]
 	return url
 
+def host_key(url):
+	"""The normalized host of a URL, i.e. lower case and without any
+	WWW. Blogs are looked up by it."""
+	host = urlparse(canonical_url(url))[1].lower()
+	if host.startswith('www.'): host = host[4:]
+	return host
+
+# Marks text packed by pack_text
+PACKED = 'zlib:'
+
+def pack_text(text):
+	"""Compresses text for a text column, as base64 after a marker."""
+	if isinstance(text, unicode): text = text.encode('utf-8')
+	return PACKED + base64.b64encode(zlib.compress(text))
+
+def unpack_text(text):
+	"""Reverses pack_text. Text without the marker, or that doesn't
+	unpack, is returned as it is, since it was stored plain."""
+	if not text or not text.startswith(PACKED): return text
+	try: return zlib.decompress(base64.b64decode(str(text[len(PACKED):])))
+	except (TypeError, UnicodeError, zlib.error): return text
+
+# The href of an <a> tag, quoted or not
+ANCHOR_HREF = re.compile(r"""<a\s(?:[^>"']|"[^"]*"|'[^']*')*?(?<=\s)""" \
+ r"""href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.IGNORECASE)
+
+def anchor_hrefs(html):
+	"""The hrefs of the <a> tags in a piece of HTML, found without
+	parsing it. Quoted hrefs are taken whole, spaces and all."""
+	return [''.join(groups).strip().replace('&amp;', '&') \
+	 for groups in ANCHOR_HREF.findall(html)]
+
 def flatten(L):
-	"""	Flattens a list
-	http://www.daniel-lemire.com/blog/archives/
-	2006/05/10/flattening-lists-in-python/"""
-	if type(L) != type([]): return [L]
-	if L == []: return L
-	return flatten(L[0]) + flatten(L[1:])
+	"""Flattens nested lists, yielding the items in order. Iterative,
+	so there's no limit on the length or depth of the lists."""
+	stack = [iter([L])]
+	while stack:
+		for item in stack[-1]:
+			if type(item) == type([]):
+				stack.append(iter(item))
+				break
+			yield item
+		else: stack.pop()
+
+def iuniq(li):
+	"""Yields the items of li, skipping those already seen."""
+	seen = set()
+	for item in li:
+		if item not in seen:
+			seen.add(item)
+			yield item
 
 def uniq(li):
-	"""Returns a list with all duplicates removed"""
-	return list(set(li))
\ No newline at end of file
+	"""Returns a list with all duplicates removed, in the order they
+	were first seen"""
+	return list(iuniq(li))
+# ========================================================================
+class test_utils(unittest.TestCase):
+	'''Tests for the URL helpers and the LRU cache.'''
+
+	def test_host_key(self):
+		self.assertEqual(host_key('http://www.Fluokids.blogspot.com/'),
+		 'fluokids.blogspot.com')
+		self.assertEqual(host_key('http://WWW.bigstereo.net/index.html'),
+		 'bigstereo.net')
+		self.assertEqual(host_key('http://a.com/b/c'), 'a.com')
+
+	def test_canonical_url(self):
+		for url, canonical in [('http://www.a.com/', 'http://a.com'),
+		 ('http://a.com/b/index.html', 'http://a.com/b'),
+		 ('http://a.com/index.htm', 'http://a.com'),
+		 ('http://a.com/b/', 'http://a.com/b/')]:
+			self.assertEqual(canonical_url(url), canonical)
+			self.assertEqual(canonical_url(url), normalize_url(url))
+		urls = ['http://www.a.com/', 'http://b.com/', 'http://www.a.com/']
+		self.assertEqual(canonical_urls(urls),
+		 ['http://a.com', 'http://b.com', 'http://a.com'])
+		self.assertEqual(www_url('http://a.com/'), 'http://www.a.com')
+
+	def test_anchor_hrefs(self):
+		html = """<p><a href="http://x.com/Artist - Song.mp3">Song</a>
+		 <A title='a > b' HREF='http://y.com/b c.mp3'>b</a> <a href=z.mp3>z</a>
+		 <a name="top">no href</a> <abbr href="x">
+		 <a class="x" href = "http://z.com/?a=1&amp;b=2">amp</a></p>"""
+		self.assertEqual(anchor_hrefs(html), ['http://x.com/Artist - Song.mp3',
+		 'http://y.com/b c.mp3', 'z.mp3', 'http://z.com/?a=1&b=2'])
+
+	def test_pack_text(self):
+		html = '<html>' + 'h\xc3\xa5j ' * 100 + '</html>'
+		packed = pack_text(html)
+		self.assert_(len(packed) < len(html))
+		self.assertEqual(unpack_text(packed), html)
+		# Text columns come back as unicode
+		self.assertEqual(unpack_text(unicode(packed)), html)
+		# Plain HTML, as stored before, non ASCII or not
+		for plain in [u'<html>h\xe5j</html>', '<html>hej</html>', u'zlib:h\xe5j', None]:
+			self.assertEqual(unpack_text(plain), plain)
+
+	def test_lists(self):
+		self.assertEqual(list(flatten([1, [2, [3, []], 4], [[5]]])), [1, 2, 3, 4, 5])
+		self.assertEqual(list(flatten(7)), [7])
+		self.assertEqual(len(list(flatten([[i] for i in range(100000)]))), 100000)
+		self.assertEqual(uniq([3, 1, 3, 2, 1]), [3, 1, 2])
+
+	def test_lru(self):
+		cache = LRUCache(3)
+		for i in range(3): cache[i] = str(i)
+		self.assertEqual(cache[0], '0')
+		cache[3] = '3'
+		self.assertEqual(len(cache), 3)
+		self.assert_(1 not in cache)
+		self.assertEqual(cache.get(1, 'gone'), 'gone')
+		cache[2] = 'two'
+		cache[4] = '4'
+		self.assertEqual(sorted(cache.links.keys()), [2, 3, 4])
+		self.assertEqual(cache.pop(2), 'two')
+		self.assertEqual(cache.pop(2), None)
+		cache.clear()
+		self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -3,11 +3,18 @@
 	Defines classes directly related to tracks, and the parsing of them,
 	especially artist metadata and track metadata (including popularity).
 """
+import threading
 
-from django.db import models
+from django.db import models, transaction, connection
 from django.contrib.auth.models import User
-from zoid.helpers.utils import get_data_from_url
+from zoid.helpers.utils import get_data_from_url, uniq, LRUCache
+from zoid.helpers.bulk import insert_rows, chunks
 #from zoid.statistics.models import TrackStatistics
+try: from django.db import IntegrityError
+except ImportError:
+	# Older versions only have it on the database module
+	from django.db import backend
+	IntegrityError = backend.Database.IntegrityError
 
 class ArtistManager(models.Manager):
 	"""Manages overarching responsibilites for the artist class."""
@@ -15,11 +22,7 @@ class ArtistManager(models.Manager):
 	def find_or_create(self, artist_name):
 		"""Finds or creates and returns an artist object given its name.
 		Case insensitive."""
-		artist = Artist.objects.filter(name__iexact=artist_name)
-		if artist: return artist[0]
-		artist = Artist(name=artist_name)
-		artist.save()
-		return artist
+		return Artist.objects.get(pk=Track.resolver.artist_ids([artist_name])[0])
 
 class Artist(models.Model):
 	"""An artist identifier, eg. 'MSTRKRFT'"""
@@ -39,21 +42,9 @@ class TrackManager(models.Manager):
 	"""Manages track related things."""
 	
 	def find_or_create(self, artist, title):
-		"""This looks especially nasty, thanks to alot of bug fixing.
-		Due for a cleanup."""
-		if artist and title:
-			artistobj = Artist.artist_manager.find_or_create(artist)
-			track = self.find_by_artist_model_and_title(artistobj, title)
-		else: track = None
-		if not track:
-			if artist:
-				artistobj = Artist.artist_manager.find_or_create(artist)
-				track = Track(artist=artistobj, title=title)
-			else:
-				track = Track(title=title)
-			track.save()
-			#TrackStatistics.manager.create_from_track(track)
-		return track
+		"""Finds or creates and returns a track given its artist, which
+		may be empty, and title. Case insensitive."""
+		return Track.objects.get(pk=Track.resolver.resolve([(artist, title)])[0])
 
 	def find_by_artist_model_and_title(self, artist, title):
 		track = Track.objects.filter(artist=artist).filter(title__iexact=title)
@@ -63,6 +54,130 @@ class TrackManager(models.Manager):
 		track = Track.objects.filter(artist__name__iexact=artist).filter(title__iexact=title)
 		if track: return track[0]
 
+class TrackResolver(models.Manager):
+	"""Resolves artist names and (artist, title) pairs to ids, creating
+	the artists and tracks we haven't got, in bulk. Names are matched
+	case insensitively. The ids of the names we've resolved are kept in
+	memory, shared by all threads; the others are looked up in one query
+	per call before anything is created, so rows that other processes
+	created are found."""
+
+	lock = threading.Lock()
+	# Names we keep the ids of, of artists and of tracks
+	CACHE_SIZE = 50000
+	# Artist key to id, and (artist id, title key) to id
+	artists = LRUCache(CACHE_SIZE)
+	tracks = LRUCache(CACHE_SIZE)
+
+	def key(name):
+		"""The normalized key of a name or title."""
+		return name.strip().lower()
+	key = staticmethod(key)
+
+	def resolve(self, pairs):
+		"""Returns the track ids for a list of (artist, title) pairs,
+		where the artist may be empty."""
+		return self.__locked(self.__resolve, pairs)
+
+	def artist_ids(self, names):
+		"""Returns the artist ids for a list of names."""
+		return self.__locked(self.__artist_ids, names)
+
+	def __locked(self, func, items):
+		"""Runs func over items under the lock, in a transaction. If
+		another process created one of the rows after we looked, the
+		insert fails, and we try once more, finding it this time."""
+		self.lock.acquire()
+		try:
+			try: return self.__commit(func, items)
+			except IntegrityError:
+				self.__forget()
+				return self.__commit(func, items)
+			except:
+				self.__forget()
+				raise
+		finally:
+			self.lock.release()
+
+	def __commit(self, func, items):
+		return func(items)
+	__commit = transaction.commit_on_success(__commit)
+
+	def __forget(self):
+		"""Drops the cached ids, some of which may have been rolled back."""
+		self.artists.clear()
+		self.tracks.clear()
+
+	def __resolve(self, pairs):
+		named = [a for a, t in pairs if a]
+		artists = dict(zip(named, self.__artist_ids(named)))
+		return self.__track_ids([(a and artists[a] or None, t) \
+		 for a, t in pairs])
+
+	def __artist_ids(self, names):
+		"""Creates the artists we haven't got, and returns the ids
+		of names."""
+		length = Artist._meta.get_field('name').max_length
+		names = [name.strip()[:length] for name in names]
+		ids, missing = {}, {}
+		for name in names:
+			key = self.key(name)
+			if key in self.artists: ids[key] = self.artists[key]
+			else: missing.setdefault(key, name)
+		if missing:
+			for id, name in self.__by_key(Artist, ['name'], missing.keys()):
+				ids.setdefault(self.key(name), id)
+			absent = [name for key, name in missing.items() if not ids.has_key(key)]
+			if absent:
+				insert_rows(Artist, ['name'], [(name,) for name in absent])
+				for rows in chunks(absent):
+					for id, name in Artist.objects.filter(name__in=rows) \
+					 .order_by('id').values_list('id', 'name'):
+						ids.setdefault(self.key(name), id)
+			for key in missing: self.artists[key] = ids[key]
+		return [ids[self.key(name)] for name in names]
+
+	def __track_ids(self, pairs):
+		"""Creates the tracks we haven't got, and returns the ids of
+		pairs, which are (artist id, title)."""
+		length = Track._meta.get_field('title').max_length
+		pairs = [(artist, title.strip()[:length]) for artist, title in pairs]
+		ids, missing = {}, {}
+		for artist, title in pairs:
+			key = (artist, self.key(title))
+			if key in self.tracks: ids[key] = self.tracks[key]
+			else: missing.setdefault(key, (artist, title, ''))
+		if missing:
+			for id, artist, title in self.__by_key(Track, ['artist_id', 'title'], \
+			 [title for artist, title in missing.keys()]):
+				ids.setdefault((artist, self.key(title)), id)
+			absent = [row for key, row in missing.items() if not ids.has_key(key)]
+			if absent:
+				insert_rows(Track, ['artist_id', 'title', 'slug'], absent)
+				for rows in chunks(uniq([title for a, title, s in absent])):
+					for id, artist, title in Track.objects.filter(title__in=rows) \
+					 .order_by('id').values_list('id', 'artist', 'title'):
+						ids.setdefault((artist, self.key(title)), id)
+			for key in missing: self.tracks[key] = ids[key]
+		return [ids[(artist, self.key(title))] for artist, title in pairs]
+
+	def __by_key(self, model, columns, keys):
+		"""Reads the id and columns of the rows of model whose last
+		column, trimmed and in lower case, is one of keys, oldest
+		first. The caller keys what's read, since not every database
+		lowers the case of everything Python does."""
+		qn = connection.ops.quote_name
+		keyed = 'LOWER(TRIM(%s))' % qn(columns[-1])
+		cursor = connection.cursor()
+		rows = []
+		for part in chunks(uniq(keys)):
+			cursor.execute("SELECT %s FROM %s WHERE %s IN (%s) ORDER BY %s" % \
+			 (', '.join([qn(column) for column in ['id'] + columns]),
+			 qn(model._meta.db_table), keyed, ', '.join(['%s'] * len(part)),
+			 qn('id')), part)
+			rows.extend(cursor.fetchall())
+		return rows
+
 class Track(models.Model):
 	"""A track identifier, i.e. 'MSTRKRFT - The Looks'"""
 	artist = models.ForeignKey(Artist, null=True, blank=True)
@@ -73,12 +188,18 @@ class Track(models.Model):
 	
 	objects = models.Manager()
 	track_manager = TrackManager()
+	resolver = TrackResolver()
 	
 	def set_user_for_relation(self,user):
 		self.user_for_relation = user
+		if hasattr(self, 'relation'): del self.relation
 	
 	def user_relation(self):
-		return Popularity.popper.state(self.user_for_relation, self)
+		"""The score the user gave the track, as attached by
+		Popularity.popper.attach, or else looked up once."""
+		if not hasattr(self, 'relation'):
+			self.relation = Popularity.popper.state(self.user_for_relation, self)
+		return self.relation
 
 	def __unicode__(self):
 		return '%(artist)s - %(title)s' % \
@@ -111,9 +232,26 @@ class PopularityManager(models.Manager):
 
 	def state(self, user, track):
 		"Returns either -1 == hate, or 1 == love."
+		if not user or not user.is_authenticated(): return None
 		trackpop = self.__get(user, track)
 		if trackpop: return trackpop.score
 
+	def states(self, user, track_ids):
+		"""Returns user's scores of a number of tracks, as a dict from track
+		id, in one query. Tracks the user never scored are left out."""
+		if not user or not user.is_authenticated() or not track_ids: return {}
+		return dict(self.filter(user=user, track__in=list(track_ids)) \
+		 .values_list('track', 'score'))
+
+	def attach(self, user, tracks):
+		"""Sets the user's score on each of a page of tracks, so that
+		user_relation needs no query of its own."""
+		scores = self.states(user, [track.id for track in tracks])
+		for track in tracks:
+			track.user_for_relation = user
+			track.relation = scores.get(track.id)
+		return tracks
+
 	def __get(self, user, track):
 		"Returns a popularity for a track. Creates a new pop object if none exists."
 		try: 
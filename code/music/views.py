@@ -1,7 +1,6 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 from django.template import RequestContext
 from django.shortcuts import render_to_response
-from django.core.paginator import Paginator, InvalidPage
 from django.contrib.auth import authenticate
 from django.contrib.auth.decorators import login_required
 from zoid.helpers.utils import *
@@ -13,19 +12,22 @@ def default_index(request):
 	return index(request, "1")
 
 def index(request, pno):
+	"""A page of the track ranking. Pages follow each other through the
+	cursor in ?after=, numbered pages are only there for old links."""
 	c = RequestContext(request,{})
-	tracks = TrackStatistics.manager.find_all()
-	for track in tracks: track.set_user_for_relation(request.user)
-	tracks.sort(lambda a,b: int(100*(b.trackstatistics.sort_score - a.trackstatistics.sort_score)))
-	pagin = Paginator(tracks, 10)
+	after = request.GET.get('after')
+	if after:
+		try: after = TrackStatistics.manager.parse_cursor(after)
+		except ValueError: raise Http404
 	if pno: pno = int(pno)
 	else: pno = 1
-	rng = pagin.page_range[(pno-1):(pno+9)]
-	if rng[0] != 1: rng = [1] + rng
-	if rng[-1] != pagin.page_range[-1]:
-		rng = rng + [pagin.page_range[-1]]
+	if after or pno < 1: pno = None
+	# The ranking is kept up to date by a job, we just read a page of it
+	tracks, cursor = TrackStatistics.manager.page(after, 10, pno and (pno-1)*10 or 0)
+	Popularity.popper.attach(request.user, tracks)
+	TrackStatistics.manager.attach_postings(tracks)
 	return render_to_response('music_index.html', \
-	 {'tracks': pagin.page(pno), 'pageno': pno, 'index_list': rng  }, c)
+	 {'tracks': tracks, 'pageno': pno, 'next': cursor }, c)
 
 def explore(request, id):
 	c = RequestContext(request,{})
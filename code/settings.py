@@ -53,6 +53,18 @@ ADMIN_MEDIA_PREFIX = '/media/'
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = 'kkm3ckp%!-3=z)!p_4$!bqb8jy*(uc8jmbrys1)*do1%%a^ft#'
 
+# Snapshot of the blog link graph, written after each spider run and
+# memory mapped by the rank job and the views. None disables it.
+GRAPH_SNAPSHOT = '/Users/marcus/zoid/blog_graph.npy'
+
+# Keep the fetched HTML of blogs, compressed, besides what we found on
+# the page. Only needed when tuning the blog roll heuristics.
+KEEP_BLOG_HTML = False
+
+# How tracks are ranked on the front page, 'hot' or 'fresh'. Hot scores
+# only change when a track is posted again, so they can be cached.
+TRACK_SCORING = 'hot'
+
 # List of callables that know how to import templates from various sources.
 TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.load_template_source',
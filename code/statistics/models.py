@@ -1,9 +1,13 @@
-from django.db import models
+from django.db import models, transaction, connection
 from zoid.music.models import Track, Artist
 from zoid.feeds.models import Enclosure, Post
+from zoid.blogs.models import Blog
+from zoid.helpers.bulk import update_column, insert_rows, delete_rows, chunks
 from datetime import datetime
 from urllib import quote_plus
+from math import log10
 import time
+from django.conf import settings
 from zoid.helpers.utils import *
 from django.db.models import Q
 
@@ -42,9 +46,11 @@ def get_similar_lastfm(artist):
 	  [re.match('([^,]+),[a-z0-9\-]*,(.+)',line) for line in data.split('\n')]\
 	 if p]
 	
-	for match in matches:
-		artist2 = Artist.artist_manager.find_or_create(match[0])
-		SoundsLike.manager.similar_lastfm(artist, artist2, match[1])
+	# The similar artists are found or created in one go
+	ids = Track.resolver.artist_ids([match[0] for match in matches])
+	artists = Artist.objects.in_bulk(uniq(ids))
+	for id, match in zip(ids, matches):
+		SoundsLike.manager.similar_lastfm(artist, artists[id], match[1])
 		
 class SoundsLikeManager(models.Manager):
 	def similar_lastfm(self, artist1, artist2, strength):
@@ -75,40 +81,146 @@ class SoundsLike(models.Model):
 class TrackStatisticsManager(models.Manager):
 	def create_from_track(self, track):
 		"""Creates a new statistic from a given track."""
-		stat = TrackStatistics(track=track)
-		stat.update_date()
-		stat.update_importance()
-		stat.update()
-		stat.save()
-		return stat
+		self.recompute([track.id])
+		return TrackStatistics.objects.get(track=track)
 		
-	def find_all(self):
-		tracks = self.update_all_nosave()
-		return tracks
+	def ranked(self, after=None):
+		"""The statistics of all tracks, highest sort score first, with
+		their tracks. If after, a (sort score, track id) cursor, is given
+		they start right after that track."""
+		stats = TrackStatistics.objects.order_by('-sort_score', 'track') \
+		 .select_related('track', 'track__artist')
+		if after:
+			score, track = after
+			stats = stats.filter(Q(sort_score__lt=score) | \
+			 Q(sort_score=score, track__gt=track))
+		return stats
 
-	def update_all_nosave(self):
+	def page(self, after=None, count=10, offset=0):
+		"""A page of the ranked tracks, read through the sort score index
+		from the cursor after, so that a page costs the same however far
+		down the ranking it is. Returns the tracks, with their sort_score
+		set, and the cursor of the next page, or None."""
+		stats = list(self.ranked(after)[offset:offset+count+1])
 		tracks = []
-		for track in Track.objects.all():
-			try: track.trackstatistics.update()
-			except: self.create_from_track(track)
-			tracks.append(track)
+		for stat in stats[:count]:
+			stat.track.sort_score = stat.sort_score
+			tracks.append(stat.track)
+		if len(stats) <= count: return (tracks, None)
+		return (tracks, self.cursor(stats[count-1]))
+
+	def attach_postings(self, tracks):
+		"""Sets postings on each of a page of tracks: a list of the
+		blog title and publishing date of each post of the track, in
+		the order they were found. Read for the whole page in one
+		query, instead of following enclosures, posts, feeds and blogs
+		track by track."""
+		qn = connection.ops.quote_name
+		postings = dict([(track.id, []) for track in tracks])
+		cursor = connection.cursor()
+		for ids in chunks(postings.keys()):
+			cursor.execute("SELECT e.%s, b.%s, p.%s FROM %s e " \
+			 "INNER JOIN %s p ON p.%s = e.%s LEFT JOIN %s b ON b.%s = p.%s " \
+			 "WHERE e.%s IN (%s) ORDER BY e.%s" % \
+			 (qn('track_id'), qn('title'), qn('published'),
+			 qn(Enclosure._meta.db_table), qn(Post._meta.db_table), qn('id'),
+			 qn('post_id'), qn(Blog._meta.db_table), qn('feed_id'), qn('feed_id'),
+			 qn('track_id'), ', '.join(['%s'] * len(ids)), qn('id')), ids)
+			for track, blog, published in cursor.fetchall():
+				postings[track].append({'blog': blog, 'published': published})
+		for track in tracks: track.postings = postings[track.id]
 		return tracks
 
-	def update_all_tracks(self):
-		for track in Track.objects.all():
-			try: 
-				track.trackstatistics.update_date()
-				track.trackstatistics.update_importance()
-				track.trackstatistics.update()
-			except: self.create_from_track(track)
-			else: track.trackstatistics.save()
-	
+	def cursor(self, stat):
+		"""The cursor for the tracks after stat, as text for a URL."""
+		return '%r,%d' % (stat.sort_score, stat.track_id)
+
+	def parse_cursor(self, text):
+		"""The (sort score, track id) of a cursor. Raises ValueError if
+		it isn't one."""
+		score, track = text.rsplit(',', 1)
+		return (float(score), int(track))
+
 	def update_all(self):
-		for stat in TrackStatistics.objects.all():
-			stat.update_date()
-			stat.update_importance()
+		"""Recomputes the statistics of all tracks, creating the missing
+		ones. Day to day, only the tracks that changed are recomputed,
+		see StaleTrack."""
+		return self.recompute()
+
+	def recompute(self, track_ids=None):
+		"""Recomputes the statistics of the given tracks, or all of them,
+		in one transaction. Returns the number of tracks."""
+		return self.write_statistics(track_ids)
+	recompute = transaction.commit_on_success(recompute)
+
+	def write_statistics(self, track_ids=None):
+		"""Does the work of recompute without committing, for callers
+		that make it part of a larger transaction. The importance and
+		the first and last time a track was seen are aggregated over
+		its enclosures in one query, and written back a column at a
+		time. Returns the number of tracks."""
+		if track_ids is None:
+			track_ids = list(Track.objects.values_list('id', flat=True))
+			seen = self.__aggregate()
+		else:
+			seen = {}
+			for ids in chunks(track_ids): seen.update(self.__aggregate(ids))
+		existing = {}
+		for ids in chunks(track_ids):
+			for id, track in TrackStatistics.objects.filter(track__in=ids) \
+			 .values_list('id', 'track'):
+				existing[track] = id
+		columns = {'global_score': [], 'published': [], 'last_seen': [], 'sort_score': []}
+		new = []
+		for track in track_ids:
+			rank, published, last_seen = seen.get(track, (0.0, None, None))
+			stat = TrackStatistics(track_id=track, global_score=float(rank or 0.0),
+			 published=min(published or datetime.today(), datetime.today()),
+			 last_seen=max(last_seen or TrackStatistics.LONG_AGO, TrackStatistics.LONG_AGO))
+			stat.update()
+			if not existing.has_key(track):
+				new.append((track, stat.global_score, stat.published, \
+				 stat.last_seen, stat.sort_score))
+				continue
+			for column, values in columns.items():
+				values.append((existing[track], getattr(stat, column)))
+		for column, values in columns.items():
+			update_column(TrackStatistics, column, values)
+		insert_rows(TrackStatistics, ['track_id', 'global_score', 'published', \
+		 'last_seen', 'sort_score'], new)
+		return len(track_ids)
+
+	def rescore(self):
+		"""Recomputes the sort scores from the stored importance and
+		dates, e.g. after changing TRACK_SCORING. With the 'fresh'
+		scoring, run it on a schedule."""
+		scores = []
+		for id, global_score, published in TrackStatistics.objects \
+		 .values_list('id', 'global_score', 'published'):
+			stat = TrackStatistics(global_score=global_score, published=published)
 			stat.update()
-			stat.save()
+			scores.append((id, stat.sort_score))
+		return update_column(TrackStatistics, 'sort_score', scores)
+	rescore = transaction.commit_on_success(rescore)
+
+	def __aggregate(self, track_ids=None):
+		"""Sums the ranks of the blogs that posted each track, and finds
+		the first and last time it was posted. Returns a dict from track
+		id to (rank, first, last)."""
+		qn = connection.ops.quote_name
+		sql = "SELECT e.%s, SUM(b.%s), MIN(p.%s), MAX(p.%s) FROM %s e " \
+		 "INNER JOIN %s p ON p.%s = e.%s LEFT JOIN %s b ON b.%s = p.%s" % \
+		 (qn('track_id'), qn('rank'), qn('published'), qn('published'),
+		 qn(Enclosure._meta.db_table), qn(Post._meta.db_table), qn('id'),
+		 qn('post_id'), qn(Blog._meta.db_table), qn('feed_id'), qn('feed_id'))
+		params = []
+		if track_ids:
+			sql += " WHERE e.%s IN (%s)" % (qn('track_id'), ', '.join(['%s'] * len(track_ids)))
+			params = list(track_ids)
+		sql += " GROUP BY e.%s" % (qn('track_id'))
+		cursor = connection.cursor()
+		cursor.execute(sql, params)
+		return dict([(row[0], row[1:]) for row in cursor.fetchall()])
 
 class TrackStatistics(models.Model):
 	"""Contains statistics on the popularity of a track."""
@@ -116,14 +228,25 @@ class TrackStatistics(models.Model):
 	global_score = models.FloatField(default=0)
 	published = models.DateTimeField()
 	last_seen = models.DateTimeField()
+	# What the front page is ordered by, as of the last update
+	sort_score = models.FloatField(default=0, db_index=True)
 	
 	objects = models.Manager()
 	manager = TrackStatisticsManager()
 	
-	sort_score = 0
-	
 	WEIGHT_FRESH 	= 2
 	WEIGHT_BLOG 	= 1
+	# The last_seen of a track nobody has posted
+	LONG_AGO		= datetime(1985, 04, 06, 0, 0, 0)
+
+	# How the sort score is computed, see update. 'hot' scores don't
+	# change with time, 'fresh' ones are relative to when they were
+	# computed, so they have to be rescored on a schedule.
+	SCORING 		= getattr(settings, 'TRACK_SCORING', 'hot')
+	# With hot scores, a track posted this many seconds later ranks as
+	# high as one posted by blogs with ten times the rank
+	HOT_DECAY 		= 86400 * WEIGHT_FRESH / WEIGHT_BLOG
+	MIN_IMPORTANCE 	= 1e-6
 	
 	def __unicode__(self):
 		try: name = self.track.artist.name
@@ -133,7 +256,7 @@ class TrackStatistics(models.Model):
 	def update_date(self):
 		# First, compute the date
 		self.published = datetime.today()
-		self.last_seen = datetime(1985, 04, 06, 0, 0, 0)
+		self.last_seen = self.LONG_AGO
 		enclosures =  self.track.enclosure_set.all()
 		for enclosure in enclosures:
 			date = enclosure.post.published
@@ -148,11 +271,27 @@ class TrackStatistics(models.Model):
 	
 	def update(self):
 		"""Recomputes the statistics for a given track."""
+		if self.SCORING == 'hot':
+			self.sort_score = self.hot()
+			return
 		# Then, magic sauce all around!
 		self.sort_score = self.WEIGHT_BLOG*self.global_score
 		freshness = self.freshness(self.published)
 		if self.sort_score != 0:
 			self.sort_score += self.WEIGHT_FRESH*freshness
+
+	def hot(self):
+		"""A score that weighs the importance of a track against how
+		recently it was posted, like the hot pages of news sites. The
+		importance counts by order of magnitude, and freshness is the
+		time between LONG_AGO and the first post, so the score doesn't
+		change until the track does. Tracks no blog of any rank posted
+		score 0."""
+		if not self.global_score: return 0.0
+		order = log10(max(self.global_score, self.MIN_IMPORTANCE))
+		seconds = time.mktime(self.published.timetuple()) - \
+		 time.mktime(self.LONG_AGO.timetuple())
+		return self.WEIGHT_BLOG*order + self.WEIGHT_FRESH*seconds/self.HOT_DECAY
 		
 	def importance(self, track):
 		"""Calculates some measure of the tracks importance as a sum of the 
@@ -171,4 +310,43 @@ class TrackStatistics(models.Model):
 		today = time.mktime(datetime.today().timetuple())
 		the_date = time.mktime(date.timetuple())
 		return 100000*1/(abs(today-the_date)+0.01)
-		
\ No newline at end of file
+
+class StaleQueue(models.Manager):
+	"""Queues the tracks whose statistics are out of date, such as the
+	tracks of new enclosures, or of blogs whose rank changed. The queue
+	is worked off by update_stale, after each feed refresh."""
+
+	# Number of queued rows handled per transaction
+	BATCH = 1000
+
+	def add(self, track_ids):
+		"""Queues tracks. A track may be queued more than once."""
+		track_ids = uniq(track_ids)
+		return insert_rows(StaleTrack, ['track_id'], [(id,) for id in track_ids])
+
+	def update_stale(self, batch=BATCH):
+		"""Recomputes the statistics of the queued tracks, and empties
+		the queue. Returns the number of tracks recomputed."""
+		count = 0
+		while True:
+			done = self.__update_batch(batch)
+			if not done: return count
+			count += done
+
+	def __update_batch(self, batch):
+		"""Recomputes a batch of queued tracks and takes them off the
+		queue, in one transaction."""
+		rows = list(StaleTrack.objects.order_by('id').values_list('id', 'track')[:batch])
+		if not rows: return 0
+		tracks = uniq([track for id, track in rows])
+		TrackStatistics.manager.write_statistics(tracks)
+		delete_rows(StaleTrack, [id for id, track in rows])
+		return len(tracks)
+	__update_batch = transaction.commit_on_success(__update_batch)
+
+class StaleTrack(models.Model):
+	"""A track whose statistics need recomputing."""
+	track = models.ForeignKey(Track)
+
+	objects = models.Manager()
+	queue = StaleQueue()